@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the TCGA DCC web service, for running and timing
+tcgaImport without network access.
+
+record : proxy GetXML queries to the real DCC, saving each response into a fixture directory
+serve  : replay recorded responses, and serve mirror archives (recorded or synthetic)
+
+Point tcgaImport at it with --dcc-url http://localhost:PORT
+"""
+
+import os
+import sys
+import json
+import tarfile
+import hashlib
+import threading
+import urllib
+import BaseHTTPServer
+import SocketServer
+from cStringIO import StringIO
+from urlparse import urlparse
+from argparse import ArgumentParser
+
+import tcgaImport
+
+DCC_URL = "http://tcga-data.nci.nih.gov"
+
+
+def fixture_key(path):
+    """
+    Recorded responses are keyed on the path and decoded query, so the same
+    query matches regardless of host or url quoting
+    """
+    u = urlparse(path)
+    return hashlib.md5(u.path + "?" + urllib.unquote(u.query)).hexdigest()
+
+
+class FixtureStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        for d in [ "responses", "files", "synthetic" ]:
+            if not os.path.exists(os.path.join(path, d)):
+                os.makedirs(os.path.join(path, d))
+        self.manifestPath = os.path.join(path, "manifest.json")
+        if os.path.exists(self.manifestPath):
+            handle = open(self.manifestPath)
+            self.manifest = json.loads(handle.read())
+            handle.close()
+        else:
+            self.manifest = { 'upstream' : DCC_URL, 'responses' : {} }
+
+    def getResponse(self, path):
+        key = fixture_key(path)
+        if key not in self.manifest['responses']:
+            return None
+        handle = open(os.path.join(self.path, "responses", key + ".xml"), "rb")
+        data = handle.read()
+        handle.close()
+        return data
+
+    def putResponse(self, path, data):
+        key = fixture_key(path)
+        handle = open(os.path.join(self.path, "responses", key + ".xml"), "wb")
+        handle.write(data)
+        handle.close()
+        with self.lock:
+            self.manifest['responses'][key] = path
+            handle = open(self.manifestPath, "w")
+            handle.write(json.dumps(self.manifest, indent=4))
+            handle.close()
+
+    def getFile(self, path, synthetic_files, synthetic_rows, synthetic_field):
+        """
+        Path on disk for a mirror file. Recorded files are used when present,
+        otherwise tarballs (and their .md5) are generated and kept under synthetic/
+        """
+        rel = path.lstrip("/")
+        recorded = os.path.join(self.path, "files", rel)
+        if os.path.exists(recorded):
+            return recorded
+        md5 = path.endswith(".md5")
+        if md5:
+            rel = rel[:-4]
+        if not rel.endswith(".tar.gz"):
+            return None
+        dst = os.path.join(self.path, "synthetic", rel)
+        with self.lock:
+            if not os.path.exists(dst):
+                synthetic_archive(dst, synthetic_files, synthetic_rows, synthetic_field)
+        if md5:
+            return dst + ".md5"
+        return dst
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = data.tell()
+    data.seek(0)
+    tar.addfile(info, data)
+
+
+def synthetic_archive(dst, file_count, row_count, field="Signal"):
+    """
+    Write a tarball of per sample level 3 matrix files, in the two header
+    'Hybridization REF' layout with 'field' values (HuEx style gene.txt
+    files), and the SDRF mapping their hybridizations to barcodes. Plus
+    the archive's .md5
+    """
+    if not os.path.exists(os.path.dirname(dst)):
+        os.makedirs(os.path.dirname(dst))
+    base = os.path.basename(dst)[:-len(".tar.gz")]
+    #barcodes stay unique across the archives of a build
+    center = hashlib.md5(base).hexdigest()[:2].upper()
+    tar = tarfile.open(dst + ".tmp", "w:gz")
+    sdrf = StringIO()
+    sdrf.write("Extract Name\tHybridization Name\tDerived Array Data Matrix File\n")
+    for i in range(file_count):
+        hyb = "%s_%d" % (base, i)
+        name = "%s.sample_%d.gene.txt" % (base, i)
+        sdrf.write("TCGA-%s-%04d-01A\t%s\t%s\n" % (center, i, hyb, name))
+        data = StringIO()
+        data.write("Hybridization REF\t%s\n" % (hyb))
+        data.write("Composite Element REF\t%s\n" % (field))
+        for r in range(row_count):
+            data.write("gene_%d\t%.4f\n" % (r, ((r * 7919 + i * 104729) % 10000) / 1000.0))
+        add_member(tar, "%s/%s" % (base, name), data)
+    add_member(tar, "%s/%s.sdrf.txt" % (base, base), sdrf)
+    tar.close()
+    os.rename(dst + ".tmp", dst)
+    handle = open(dst + ".md5", "w")
+    handle.write("%s  %s\n" % (tcgaImport.fileDigest(dst), os.path.basename(dst)))
+    handle.close()
+
+
+class FixtureHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_data(self, code, data, ctype="text/xml"):
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def rewrite(self, data):
+        #paging links point at the recorded host, send clients back here instead
+        host = self.headers.getheader("host", "%s:%d" % self.server.server_address)
+        return data.replace(self.server.store.manifest['upstream'], "http://" + host)
+
+    def do_GET(self):
+        store = self.server.store
+        if self.path.startswith("/tcgadccws/"):
+            data = store.getResponse(self.path)
+            if data is None and self.server.options.mode == "record":
+                handle = tcgaImport.http_session.urlopen(store.manifest['upstream'] + self.path)
+                data = handle.read()
+                handle.close()
+                store.putResponse(self.path, data)
+            if data is None:
+                self.send_data(404, "No recorded response for %s\n" % (self.path), "text/plain")
+                return
+            self.send_data(200, self.rewrite(data))
+            return
+        options = self.server.options
+        path = store.getFile(urlparse(self.path).path, options.synthetic_files, options.synthetic_rows, options.synthetic_field)
+        if path is None:
+            self.send_data(404, "Not found: %s\n" % (self.path), "text/plain")
+            return
+        self.send_file(path)
+
+    def send_file(self, path):
+        size = os.path.getsize(path)
+        start = 0
+        rng = self.headers.getheader("range")
+        if rng is not None and rng.startswith("bytes=") and rng[6:].endswith("-") and rng[6:-1].isdigit():
+            start = int(rng[6:-1])
+        if start >= size and size > 0:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % (size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if start > 0:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        handle = open(path, "rb")
+        handle.seek(start)
+        for chunk in iter(lambda: handle.read(65536), ''):
+            self.wfile.write(chunk)
+        handle.close()
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def main_serve(options):
+    store = FixtureStore(options.fixtures)
+    if options.mode == "record" and options.upstream is not None:
+        store.manifest['upstream'] = options.upstream.rstrip("/")
+    server = FixtureServer((options.host, options.port), FixtureHandler)
+    server.store = store
+    server.options = options
+    sys.stderr.write("%s fixtures in %s on http://%s:%d\n" % (options.mode, options.fixtures, options.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(title="subcommand")
+    for mode in [ "serve", "record" ]:
+        p = subparsers.add_parser(mode)
+        p.add_argument("fixtures", help="Fixture directory")
+        p.add_argument("--host", default="localhost")
+        p.add_argument("-p", "--port", type=int, default=8765)
+        p.add_argument("--synthetic-files", dest="synthetic_files", type=int, help="Files per synthetic archive", default=20)
+        p.add_argument("--synthetic-rows", dest="synthetic_rows", type=int, help="Rows per synthetic file", default=20000)
+        p.add_argument("--synthetic-field", dest="synthetic_field", help="Value column type of synthetic files (the importer's probeField, eg Signal or Beta_value)", default="Signal")
+        p.add_argument("-v", "--verbose", action="store_true", default=False)
+        if mode == "record":
+            p.add_argument("--upstream", help="DCC location to record from", default=DCC_URL)
+        p.set_defaults(func=main_serve, mode=mode)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+"""
+Timing harness for tcgaImport internals, run against recorded or synthetic data
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import subprocess
+from glob import glob
+from argparse import ArgumentParser
+
+import tcgaImport
+
+
+def run_child(func, *args):
+    """
+    Run func in a forked child, so every measurement gets its own peak RSS.
+    Returns (result_line, wall_seconds, peak_rss_kb)
+    """
+    rfd, wfd = os.pipe()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            out = str(func(*args))
+        except Exception, e:
+            out = "ERROR %s" % (e)
+        os.write(wfd, out)
+        os._exit(0)
+    os.close(wfd)
+    handle = os.fdopen(rfd)
+    out = handle.read()
+    handle.close()
+    _, status, usage = os.wait4(pid, 0)
+    return out, time.time() - start, usage.ru_maxrss
+
+
+def xml_parse_pages(parser, pages):
+    count = 0
+    for path in pages:
+        handle = open(path, "rb")
+        data = handle.read()
+        handle.close()
+        records, next = parser(data)
+        count += len(records)
+    return count
+
+
+def main_xml(options):
+    pages = []
+    for path in options.pages:
+        if os.path.isdir(path):
+            pages += glob(os.path.join(path, "*.xml")) + glob(os.path.join(path, "*", "*.xml"))
+        else:
+            pages.append(path)
+    if not len(pages):
+        sys.stderr.write("No response pages found\n")
+        return 1
+    pages = pages * options.repeat
+    print "pages: %d" % (len(pages))
+    for name, parser in [ ("minidom", tcgaImport.parseResponseDOM), ("iterparse", tcgaImport.parseResponse) ]:
+        count, wall, rss = run_child(xml_parse_pages, parser, pages)
+        print "%s\trecords: %s\trecords/sec: %.0f\tpeak_rss_kb: %d" % (name, count, int(count) / wall, rss)
+    return 0
+
+
+def glob_scan(root, excludes):
+    """
+    The previous scandirs: recursive glob, every exclude pattern searched per file
+    """
+    count = 0
+    if os.path.isdir(root):
+        for a in glob(os.path.join(root, "*")):
+            count += glob_scan(a, excludes)
+    else:
+        name = os.path.basename(root)
+        for e in excludes:
+            if tcgaImport.re.search(e, name):
+                return 0
+        count += 1
+    return count
+
+
+def inventory_scan(root, excludes):
+    exclude_re = tcgaImport.combine_patterns(excludes)
+    count = 0
+    for path, size in tcgaImport.FileInventory([root]):
+        if exclude_re.search(os.path.basename(path)) is None:
+            count += 1
+    return count
+
+
+def synthetic_tree(dst, file_count, per_dir):
+    """
+    Empty clinical style tree, 'per_dir' xml files per archive directory,
+    plus the usual DCC manifest files
+    """
+    for i in range(file_count):
+        dir = os.path.join(dst, "archive_%d" % (i / per_dir))
+        if i % per_dir == 0:
+            os.makedirs(dir)
+            for name in [ "MANIFEST.txt", "README_DCC.txt", "CHANGES_DCC.txt" ]:
+                open(os.path.join(dir, name), "w").close()
+        open(os.path.join(dir, "nationwidechildrens.org_clinical.TCGA-%06d.xml" % (i)), "w").close()
+
+
+def main_walk(options):
+    tmp = None
+    root = options.tree
+    if root is None:
+        tmp = tempfile.mkdtemp(dir=options.workdir)
+        root = os.path.join(tmp, "tree")
+        synthetic_tree(root, options.synthetic, options.per_dir)
+    try:
+        print "tree: %s\tscandir module: %s" % (root, tcgaImport.scandir is not None)
+        for name, func in [ ("glob", glob_scan), ("inventory", inventory_scan) ]:
+            for i in range(options.repeat):
+                count, wall, rss = run_child(func, root, tcgaImport.FileImporter.excludes)
+                print "%s\tfiles: %s\tseconds: %.3f\tfiles/sec: %.0f" % (name, count, wall, int(count) / wall)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+    return 0
+
+
+def spill_records(count, samples):
+    """
+    Synthetic matrix probe records, as TCGAMatrixImport.fileScan emits them
+    """
+    for i in xrange(count):
+        yield "cg%08d" % (i / samples), { "target" : "TCGA-%02d-%04d-01A" % (i % 50, i % samples), "Beta_value" : "%.6f" % ((i * 7919 % 100000) / 100000.0) }
+
+
+def spill_text(path, count, samples):
+    start = time.time()
+    handle = open(path, "w")
+    for key, data in spill_records(count, samples):
+        handle.write( "%s\t%s\n" % (key, json.dumps(data)))
+    handle.close()
+    write = time.time() - start
+    start = time.time()
+    n = 0
+    for key, value in tcgaImport.TableReader(path):
+        n += 1
+    return "%.3f %.3f %d" % (write, time.time() - start, os.path.getsize(path))
+
+
+def spill_binary(path, count, samples, codec=None):
+    start = time.time()
+    out = tcgaImport.SpillWriter(path, codec)
+    for key, data in spill_records(count, samples):
+        out.write(key, data)
+    out.close()
+    write = time.time() - start
+    start = time.time()
+    n = 0
+    for key, value in tcgaImport.TableReader(path):
+        n += 1
+    return "%.3f %.3f %d" % (write, time.time() - start, os.path.getsize(path))
+
+
+def main_spill(options):
+    """
+    Cost of writing and reading back a port's spill file, JSON lines
+    against the binary format, uncompressed and with each available codec
+    """
+    tmp = tempfile.mkdtemp(dir=options.workdir)
+    try:
+        base = None
+        start = time.time()
+        for key, data in spill_records(options.records, options.samples):
+            pass
+        base = time.time() - start
+        print "records: %d\tgenerate: %.3fs" % (options.records, base)
+        runs = [ ("text", spill_text, []), ("binary", spill_binary, [None]) ]
+        for codec in sorted(tcgaImport.SPILL_CODECS):
+            runs.append( ("binary+" + codec, spill_binary, [codec]) )
+        for name, func, args in runs:
+            out, wall, rss = run_child(func, os.path.join(tmp, name), options.records, options.samples, *args)
+            write, read, size = out.split(" ")
+            print "%s\twrite: %.3fs\tread: %.3fs\tserialization: %.3fs\tsize: %.1f MB\tbytes/record: %.1f" % (name, 
+                float(write), float(read), float(write) - base + float(read), int(size) / 1048576.0, int(size) / float(options.records))
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+def matrix_rows(probes, samples):
+    """
+    Synthetic methylation style cohort: per probe, the target -> value
+    string dict fileBuild gathers, about 1 in 20 values missing
+    """
+    for p in xrange(probes):
+        data = {}
+        for s in xrange(samples):
+            if (p * 31 + s * 17) % 20:
+                data["TARGET-%04d" % (s)] = "%.4f" % (((p * 7919 + s * 104729) % 10000) / 10000.0)
+        yield "cg%08d" % (p), data
+
+
+def matrix_importer(uuids):
+    conf = tcgaImport.BuildConf("bench", "TEST", "bench", {}, [])
+    imp = tcgaImport.TCGAMatrixImport(conf, None)
+    tTrans = dict( (t, t.replace("TARGET", "UUID")) for t in uuids )
+    tEnum = dict( (tTrans[t], i) for i, t in enumerate(sorted(tTrans)) )
+    return imp, tTrans, tEnum
+
+
+def matrix_lookup(path, probes, samples, uuids):
+    """
+    The previous fileBuild row assembly: target translation and column
+    lookup per value
+    """
+    imp, tTrans, tEnum = matrix_importer(uuids)
+    handle = open(path, "w")
+    count = 0
+    for probe, data in matrix_rows(probes, samples):
+        out = ["NA"] * len(tEnum)
+        for target in data:
+            ttarget = imp.translateUUID(tTrans[target])
+            if ttarget is not None:
+                out[ tEnum[ ttarget ] ] = str( data[ target ] )
+        if out.count("NA") != len(tEnum):
+            count += 1
+            handle.write( "%s\t%s\n" % ( probe, "\t".join( out ) ) )
+    handle.close()
+    return count
+
+
+def matrix_writer(path, probes, samples, uuids, writer):
+    imp, tTrans, tEnum = matrix_importer(uuids)
+    tColumn = dict( (t, tEnum.get(imp.translateUUID(tTrans[t]))) for t in tTrans )
+    out = writer(path, sorted(tEnum, key=tEnum.get))
+    for probe, data in matrix_rows(probes, samples):
+        cells = {}
+        for target in data:
+            if tColumn[target] is not None:
+                cells[ tColumn[target] ] = str( data[target] )
+        out.addRow(probe, cells)
+    out.close()
+    return out.rowCount
+
+
+def main_matrix(options):
+    """
+    Matrix assembly rows/sec: per value lookups against the column index
+    cache, with the text writer, and the cost of normalising to float32
+    with the numpy writer
+    """
+    tmp = tempfile.mkdtemp(dir=options.workdir)
+    try:
+        uuids = [ "TARGET-%04d" % (s) for s in range(options.samples) ]
+        start = time.time()
+        for probe, data in matrix_rows(options.probes, options.samples):
+            pass
+        base = time.time() - start
+        print "probes: %d\tsamples: %d\tgenerate: %.3fs" % (options.probes, options.samples, base)
+        runs = [ ("lookup", matrix_lookup, []), ("text", matrix_writer, [tcgaImport.MatrixWriter]) ]
+        if tcgaImport.numpy is not None:
+            runs.append( ("float32", matrix_writer, [tcgaImport.FloatMatrixWriter]) )
+        for name, func, args in runs:
+            count, wall, rss = run_child(func, os.path.join(tmp, name), options.probes, options.samples, uuids, *args)
+            print "%s\trows: %s\tseconds: %.3f\trows/sec: %.0f\tpeak_rss_kb: %d" % (name, count, wall - base, int(count) / (wall - base), rss)
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+def main_build(options):
+    """
+    Time complete 'tcgaImport.py build' runs, usually against a dccwsFixture.py stand-in
+    """
+    cmd = [ sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tcgaImport.py"), "build", "--net-stats" ] + options.build_args
+    if options.dcc_url is not None:
+        cmd += [ "--dcc-url", options.dcc_url ]
+    times = []
+    for i in range(options.repeat):
+        start = time.time()
+        ret = subprocess.call(cmd, stdout=open(os.devnull, "w"))
+        times.append(time.time() - start)
+        print "run %d\texit: %d\tseconds: %.2f" % (i, ret, times[-1])
+        if ret != 0:
+            return ret
+    times.sort()
+    print "builds: %d\tmin: %.2f\tmedian: %.2f\tmax: %.2f" % (len(times), times[0], times[len(times)/2], times[-1])
+    return 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(title="subcommand")
+
+    parser_xml = subparsers.add_parser('xml', help="DCC queryResponse parsing, over recorded pages (eg a --cache-dir)")
+    parser_xml.add_argument("pages", nargs="+", help="Response page files or directories")
+    parser_xml.add_argument("--repeat", type=int, default=1)
+    parser_xml.set_defaults(func=main_xml)
+
+    parser_walk = subparsers.add_parser('walk', help="Directory scan: recursive glob against the file inventory walker")
+    parser_walk.add_argument("tree", nargs="?", help="Extracted archive tree (default: build a synthetic clinical tree)", default=None)
+    parser_walk.add_argument("--synthetic", type=int, help="Files in the synthetic tree", default=20000)
+    parser_walk.add_argument("--per-dir", dest="per_dir", type=int, help="Files per archive directory in the synthetic tree", default=500)
+    parser_walk.add_argument("-w", "--workdir", help="Where to build the synthetic tree", default="/tmp")
+    parser_walk.add_argument("--repeat", type=int, default=3)
+    parser_walk.set_defaults(func=main_walk)
+
+    parser_spill = subparsers.add_parser('spill', help="Spill file encoding: JSON lines against the binary format and its codecs")
+    parser_spill.add_argument("--records", type=int, default=1000000)
+    parser_spill.add_argument("--samples", type=int, help="Records per key", default=500)
+    parser_spill.add_argument("-w", "--workdir", help="Where to write the spill files", default="/tmp")
+    parser_spill.set_defaults(func=main_spill)
+
+    parser_matrix = subparsers.add_parser('matrix', help="Matrix assembly: per value lookups, the text writer and float32 normalisation")
+    parser_matrix.add_argument("--probes", type=int, default=50000)
+    parser_matrix.add_argument("--samples", type=int, default=200)
+    parser_matrix.add_argument("-w", "--workdir", help="Where to write the matrices", default="/tmp")
+    parser_matrix.set_defaults(func=main_matrix)
+
+    parser_build = subparsers.add_parser('build', help="End to end 'tcgaImport.py build' timing")
+    parser_build.add_argument("--dcc-url", dest="dcc_url", help="DCC stand-in location (see dccwsFixture.py)", default=None)
+    parser_build.add_argument("--repeat", type=int, default=3)
+    parser_build.add_argument("build_args", nargs="+", help="Arguments passed to 'tcgaImport.py build' (after --)")
+    parser_build.set_defaults(func=main_build)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
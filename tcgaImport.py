@@ -7,8 +7,9 @@ Script to scan and extract TCGA data and compile it into coherent matrices
 """
 
 from xml.dom.minidom import parseString
+from xml.etree.cElementTree import iterparse, ParseError
+from cStringIO import StringIO
 import urllib
-import urllib2
 import time
 import os
 import csv
@@ -21,13 +22,40 @@ import random
 import json
 import datetime
 import hashlib
-import subprocess
+import threading
+import multiprocessing
+import Queue
+import sqlite3
+import tarfile
+import fcntl
+from collections import OrderedDict
+from contextlib import closing
 from glob import glob
 import shutil
-import subprocess
 import logging
+import struct
+import marshal
+import heapq
+import zlib
+import array
+from json.encoder import encode_basestring_ascii
 from argparse import ArgumentParser
-from urlparse import urlparse
+from urlparse import urlparse, urljoin
+import httplib
+import socket
+import stat
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+try:
+    import lz4.block as lz4block
+except ImportError:
+    lz4block = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 
@@ -37,50 +65,1019 @@ Net query code
 
 """
 
+class HTTPError(IOError):
+    def __init__(self, url, code, msg, retry_after=None):
+        IOError.__init__(self, "HTTP %s %s: %s" % (code, msg, url))
+        self.url = url
+        self.code = code
+        self.retry_after = retry_after
+
+
+class HTTPResponse(object):
+    """
+    File like wrapper around an httplib response. The connection goes back to
+    the session pool once the body has been fully read.
+    """
+    def __init__(self, session, key, conn, response, url):
+        self.session = session
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.headers = response.msg
+        self.buffer = ''
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self, size=-1):
+        if self.response is None:
+            out = self.buffer
+            self.buffer = ''
+            return out
+        if size is None or size < 0:
+            out = self.buffer + self.response.read()
+            self.buffer = ''
+            self.finish()
+            return out
+        if len(self.buffer) >= size:
+            out = self.buffer[:size]
+            self.buffer = self.buffer[size:]
+            return out
+        out = self.buffer + self.response.read(size - len(self.buffer))
+        self.buffer = ''
+        if not len(out):
+            self.finish()
+        return out
+
+    def readline(self):
+        while self.buffer.find("\n") < 0 and self.response is not None:
+            block = self.response.read(65536)
+            if not len(block):
+                self.finish()
+            self.buffer += block
+        i = self.buffer.find("\n")
+        if i < 0:
+            out = self.buffer
+            self.buffer = ''
+        else:
+            out = self.buffer[:i+1]
+            self.buffer = self.buffer[i+1:]
+        return out
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not len(line):
+                break
+            yield line
+
+    def finish(self):
+        if self.response is not None:
+            if self.response.isclosed() and not self.response.will_close:
+                self.session.release(self.key, self.conn)
+            else:
+                self.conn.close()
+            self.response = None
+
+    def close(self):
+        if self.response is not None:
+            #body not read to the end, the connection can't be reused
+            self.response.close()
+            self.conn.close()
+            self.response = None
+        self.buffer = ''
+
+
+class HTTPSession(object):
+    """
+    Persistent per host HTTP/HTTPS connections, shared by all of the DCC
+    queries and mirror downloads. At most pool_size idle connections are
+    kept for each host.
+    """
+    def __init__(self, pool_size=4, timeout=600):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stats = { 'requests' : 0, 'new' : 0, 'reused' : 0 }
+
+    def connect(self, key):
+        with self.lock:
+            self.stats['requests'] += 1
+            if len(self.idle.get(key, [])):
+                self.stats['reused'] += 1
+                return self.idle[key].pop(), True
+        return self.newConnection(key), False
+
+    def newConnection(self, key):
+        with self.lock:
+            self.stats['new'] += 1
+        scheme, host, port = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.pool_size:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def urlopen(self, url, data=None, headers=None):
+        method = "GET"
+        headers = dict(headers or {})
+        if data is not None:
+            method = "POST"
+            headers['Content-Type'] = "application/x-www-form-urlencoded"
+        for redirect in range(10):
+            u = urlparse(url)
+            key = (u.scheme, u.hostname, u.port)
+            path = u.path or "/"
+            if u.query:
+                path += "?" + u.query
+            conn, reused = self.connect(key)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                #server dropped the idle connection, try once on a fresh one
+                conn = self.newConnection(key)
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+            out = HTTPResponse(self, key, conn, response, url)
+            location = response.getheader("location")
+            if response.status in [301, 302, 303, 307] and location is not None:
+                out.read()
+                url = urljoin(url, location)
+                if response.status != 307:
+                    method = "GET"
+                    data = None
+                    headers = {}
+                continue
+            if response.status >= 400:
+                out.read()
+                retry_after = response.getheader("retry-after")
+                if retry_after is not None and retry_after.isdigit():
+                    retry_after = int(retry_after)
+                else:
+                    retry_after = None
+                raise HTTPError(url, response.status, response.reason, retry_after)
+            return out
+        raise HTTPError(url, response.status, "Too many redirects")
+
+    def urlretrieve(self, url, dst, data=None):
+        handle = self.urlopen(url, data)
+        oHandle = open(dst, "wb")
+        for chunk in iter(lambda: handle.read(65536), ''):
+            oHandle.write(chunk)
+        oHandle.close()
+        handle.close()
+        return dst
+
+
+http_session = HTTPSession()
+
+
+class ArchiveDownloader(object):
+    """
+    Fetch mirror archives with a pool of worker threads. Transfers go to
+    '<dst>.part' and resume with a Range request if interrupted. The file is
+    checked against its .md5 before being renamed into place, so the mirror
+    never holds a truncated archive under its final name.
+    """
+    def __init__(self, workers=4, retries=3):
+        self.workers = workers
+        self.governor = RequestGovernor(max_retries=retries)
+        self.lock = threading.Lock()
+        self.bytes = 0
+
+    def transfer(self, url, part):
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+        headers = {}
+        if offset > 0:
+            headers['Range'] = "bytes=%d-" % (offset)
+        try:
+            handle = http_session.urlopen(url, headers=headers)
+        except HTTPError, e:
+            if e.code == 416:
+                return #part file already holds everything
+            raise
+        #both handles are closed before a failure reaches the governor, so
+        #a retry sizes the part file with everything written flushed
+        try:
+            if handle.getcode() != 206:
+                offset = 0
+            length = handle.info().getheader("Content-Length")
+            received = 0
+            oHandle = open(part, "r+b" if offset > 0 else "wb")
+            try:
+                oHandle.seek(offset)
+                for chunk in iter(lambda: handle.read(1048576), ''):
+                    oHandle.write(chunk)
+                    received += len(chunk)
+                    with self.lock:
+                        self.bytes += len(chunk)
+            finally:
+                oHandle.close()
+        finally:
+            handle.close()
+        #httplib ends a cut off body quietly, make it a retryable error
+        if length is not None and received < int(length):
+            raise IOError("Transfer of %s ended after %d of %s bytes" % (url, received, length))
+
+    def streamExtract(self, url, part, extract_dir, accept=None, stats=None):
+        """
+        Single pass transfer: the response is hashed, written to the part
+        file and unpacked into extract_dir as it arrives. Returns the md5.
+        """
+        handle = http_session.urlopen(url)
+        try:
+            length = handle.info().getheader("Content-Length")
+            oHandle = open(part, "wb")
+            try:
+                tee = DigestTee(handle, oHandle)
+                try:
+                    tar = tarfile.open(fileobj=tee, mode="r|gz")
+                    try:
+                        extractMembers(tar, extract_dir, accept, stats)
+                    finally:
+                        tar.close()
+                except (tarfile.TarError, EOFError, zlib.error):
+                    #a cut off body reads as a broken archive, retry it
+                    if length is not None and tee.bytes < int(length):
+                        raise IOError("Transfer of %s ended after %d of %s bytes" % (url, tee.bytes, length))
+                    raise
+                #drain the end of archive padding, so the digest covers the whole file
+                for chunk in iter(lambda: tee.read(1048576), ''):
+                    pass
+            finally:
+                oHandle.close()
+        finally:
+            handle.close()
+        with self.lock:
+            self.bytes += tee.bytes
+        return tee.md5.hexdigest()
+
+    def readText(self, url):
+        handle = http_session.urlopen(url)
+        try:
+            return handle.read()
+        finally:
+            handle.close()
+
+    def fetch(self, url, dst, extract_dir=None, accept=None, stats=None):
+        dir = os.path.dirname(dst)
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                pass
+        part = dst + ".part"
+        omd5 = None
+        try:
+            md5_text = self.governor.call(url + ".md5", self.readText)
+            omd5 = md5_text.split(' ')[0]
+        except HTTPError, e:
+            if e.code != 404:
+                raise
+            md5_text = None
+            logging.warning("No md5 available for %s" % (url))
+        if extract_dir is not None:
+            dest = os.path.join(extract_dir, archiveDirName(dst))
+            nmd5 = self.governor.call(url, lambda u: self.streamExtract(u, part, dest, accept, stats))
+        else:
+            self.governor.call(url, lambda u: self.transfer(u, part))
+            nmd5 = None
+        if omd5 is not None:
+            if nmd5 is None:
+                nmd5 = fileDigest(part)
+            if omd5 != nmd5:
+                os.unlink(part)
+                raise Exception("CORRUPT: %s (expected %s got %s)" % (url, omd5, nmd5))
+            handle = open(dst + ".md5", "w")
+            handle.write(md5_text)
+            handle.close()
+        os.rename(part, dst)
+        if omd5 is not None:
+            recordVerified(dst, omd5)
+
+    def run(self, jobs, extract_dir=None, accept=None, stats=None):
+        """
+        jobs is a list of (url, dst) pairs, downloaded concurrently. If
+        extract_dir is given, archives are also unpacked while streaming, each
+        into its own subdirectory, keeping the members that pass accept(name).
+        """
+        start = time.time()
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+        errors = []
+
+        def worker():
+            while True:
+                try:
+                    url, dst = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                print "download %s to %s" % (url, dst)
+                try:
+                    self.fetch(url, dst, extract_dir, accept, stats)
+                except Exception, e:
+                    with self.lock:
+                        errors.append("%s: %s" % (url, e))
+
+        threads = []
+        for i in range(min(self.workers, len(jobs))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        if len(jobs):
+            print "downloaded %d archives, %.1f MB in %.1fs (%.2f MB/s)" % (len(jobs) - len(errors), self.bytes / 1048576.0, elapsed, self.bytes / 1048576.0 / max(elapsed, 0.001))
+        if len(errors):
+            raise Exception("Download failed: %s" % ("; ".join(errors)))
+
+
+class DigestTee(object):
+    """
+    Read through wrapper, hashing and copying the stream as it is consumed
+    """
+    def __init__(self, handle, out):
+        self.handle = handle
+        self.out = out
+        self.md5 = hashlib.md5()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.md5.update(data)
+        self.out.write(data)
+        self.bytes += len(data)
+        return data
+
+
+def safeMember(member):
+    """
+    Reject archive members that would land outside the extraction directory
+    """
+    if member.name.startswith("/") or ".." in member.name.split("/"):
+        return False
+    if member.issym() or member.islnk():
+        return not (member.linkname.startswith("/") or ".." in member.linkname.split("/"))
+    return True
+
+
+class ExtractStats(object):
+    """
+    Running totals of archive members written to disk versus filtered out
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = { 'extracted' : [0, 0], 'skipped' : [0, 0] }
+        self.write_seconds = 0.0
+
+    def add(self, kind, size, seconds=0.0):
+        with self.lock:
+            self.counts[kind][0] += 1
+            self.counts[kind][1] += size
+            self.write_seconds += seconds
+
+    def merge(self, counts, write_seconds):
+        with self.lock:
+            for kind in counts:
+                self.counts[kind][0] += counts[kind][0]
+                self.counts[kind][1] += counts[kind][1]
+            self.write_seconds += write_seconds
+
+    def report(self, seconds):
+        ext_files, ext_bytes = self.counts['extracted']
+        skip_files, skip_bytes = self.counts['skipped']
+        out = "extracted %d files (%.1f MB), skipped %d files (%.1f MB) in %.1fs" % (ext_files, ext_bytes / 1048576.0, skip_files, skip_bytes / 1048576.0, seconds)
+        if ext_bytes > 0 and self.write_seconds > 0:
+            #estimate, assuming skipped members would have written at the observed rate
+            out += ", est. %.1fs saved" % (skip_bytes * self.write_seconds / ext_bytes)
+        return out
+
+
+def extractMembers(tar, dest, accept=None, stats=None):
+    """
+    Unpack the file members of an open tarfile for which accept(name) is
+    true. Members are visited in archive order, so streamed tars work too.
+    """
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    for member in tar:
+        if not safeMember(member) or member.isdir():
+            continue
+        if accept is None or accept(member.name):
+            start = time.time()
+            tar.extract(member, dest)
+            if stats is not None:
+                stats.add('extracted', member.size, time.time() - start)
+        elif stats is not None:
+            stats.add('skipped', member.size)
+
+
+def archiveDirName(path):
+    """
+    Name of the work directory subdirectory an archive is unpacked into
+    """
+    name = os.path.basename(path)
+    for ext in [ ".tar.gz", ".tgz", ".tar" ]:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+#member filter for extraction worker processes, inherited when the pool forks
+_extract_accept = None
+
+def extract_archive(job):
+    path, dest = job
+    stats = ExtractStats()
+    tar = tarfile.open(path, "r|gz")
+    extractMembers(tar, dest, _extract_accept, stats)
+    tar.close()
+    return stats.counts, stats.write_seconds
+
+def extract_archives(jobs, accept=None, workers=1):
+    """
+    Unpack (archive, dest) jobs, decompressing up to 'workers' archives at
+    once in separate processes. Returns (counts, write_seconds) for each job.
+    """
+    global _extract_accept
+    _extract_accept = accept
+    if workers <= 1 or len(jobs) <= 1:
+        return map(extract_archive, jobs)
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(extract_archive, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def combine_patterns(patterns):
+    """
+    Compile a list of regular expressions into one alternation, so a name
+    is tested against all of them in a single match/search call
+    """
+    return re.compile("|".join( "(?:%s)" % (p) for p in patterns ))
+
+
+def walk_files(root):
+    """
+    Iterative walk yielding (path, size) for each file under root, in sorted
+    name order. Hidden entries are skipped, as glob('*') did. Uses the
+    scandir module when it is installed, to save a stat per directory entry.
+    """
+    stack = [root]
+    while len(stack):
+        path = stack.pop()
+        dirs = []
+        if scandir is not None:
+            for entry in sorted(scandir(path), key=lambda e: e.name):
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                else:
+                    yield entry.path, entry.stat().st_size
+        else:
+            for name in sorted(os.listdir(path)):
+                if name.startswith("."):
+                    continue
+                entry = os.path.join(path, name)
+                st = os.stat(entry)
+                if stat.S_ISDIR(st.st_mode):
+                    dirs.append(entry)
+                else:
+                    yield entry, st.st_size
+        dirs.reverse()
+        stack.extend(dirs)
+
+
+class FileInventory(object):
+    """
+    List of the (path, size) of every file under a set of directories,
+    walked once and reusable by later passes
+    """
+    def __init__(self, roots):
+        self.files = []
+        for root in roots:
+            if os.path.isdir(root):
+                self.files.extend(walk_files(root))
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def totalSize(self):
+        return sum( size for path, size in self.files )
+
+
+def balance_shards(jobs, count):
+    """
+    Split (size, job) pairs into at most count lists of jobs with similar
+    total size, placing the largest jobs first
+    """
+    shards = []
+    for i in range(min(count, len(jobs))):
+        shards.append( [0, i, []] )
+    for size, job in sorted(jobs, key=lambda j: -j[0]):
+        shard = min(shards)
+        shard[0] += size
+        shard[2].append(job)
+    return [ shard[2] for shard in shards ]
+
+
+#importer for scan worker processes, inherited when the pool forks
+_scan_importer = None
+
+def scan_shard(task):
+    shard, method, args = task
+    imp = _scan_importer
+    imp.shard = shard
+    imp.out = {}
+    getattr(imp, method)(*args)
+    for o in imp.out:
+        imp.out[o].close()
+    return shard
+
+
+class ExtractCache(object):
+    """
+    Persistent extraction trees, keyed by archive md5 and shared between
+    builds on the same node.
+
+    <path>/<md5>/      complete extraction of the archive
+    <path>/<md5>.json  entry record (size, last use), written once the tree is complete
+    <path>/<md5>.lock  held with a shared flock by every build using the entry
+
+    The shared flocks act as the reference count: the kernel drops them when
+    a build exits, even if it crashes. Entries are evicted least recently
+    used first, once the cache exceeds max_bytes, skipping any entry still
+    locked.
+    """
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.held = []
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass #created by a concurrent build
+
+    def entryPath(self, md5, ext=""):
+        return os.path.join(self.path, md5 + ext)
+
+    def lockCache(self):
+        handle = open(os.path.join(self.path, "lock"), "a")
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        return handle
+
+    def readEntry(self, md5):
+        try:
+            handle = open(self.entryPath(md5, ".json"))
+            entry = json.loads(handle.read())
+            handle.close()
+            return entry
+        except (IOError, ValueError):
+            return None
+
+    def writeEntry(self, md5, entry):
+        handle = open(self.entryPath(md5, ".json.tmp"), "w")
+        handle.write(json.dumps(entry))
+        handle.close()
+        os.rename(self.entryPath(md5, ".json.tmp"), self.entryPath(md5, ".json"))
+
+    def acquire(self, archive):
+        """
+        Returns the directory holding the contents of archive, extracting it
+        on a miss. The entry stays pinned until release() is called.
+        """
+        md5 = archiveDigest(archive)
+        ref = open(self.entryPath(md5, ".lock"), "a")
+        fcntl.flock(ref, fcntl.LOCK_SH)
+        self.held.append(ref)
+        lock = self.lockCache()
+        try:
+            entry = self.readEntry(md5)
+            if entry is not None:
+                entry['used'] = time.time()
+                self.writeEntry(md5, entry)
+                print "extract cache hit %s (%s)" % (os.path.basename(archive), md5)
+                return self.entryPath(md5)
+        finally:
+            lock.close()
+        #extract outside the cache lock, other builds may be extracting at the same time
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=md5 + ".tmp.")
+        try:
+            tar = tarfile.open(archive, "r|gz")
+            extractMembers(tar, tmp)
+            tar.close()
+            size = 0
+            for dirpath, dirnames, filenames in os.walk(tmp):
+                for name in filenames:
+                    size += os.path.getsize(os.path.join(dirpath, name))
+            lock = self.lockCache()
+            try:
+                if self.readEntry(md5) is None:
+                    if os.path.exists(self.entryPath(md5)):
+                        shutil.rmtree(self.entryPath(md5)) #left by an interrupted build
+                    os.rename(tmp, self.entryPath(md5))
+                    self.writeEntry(md5, { 'archive' : os.path.basename(archive), 'bytes' : size, 'used' : time.time() })
+                self.evict()
+            finally:
+                lock.close()
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+        print "extract cache miss %s (%s)" % (os.path.basename(archive), md5)
+        return self.entryPath(md5)
+
+    def release(self):
+        for ref in self.held:
+            ref.close()
+        self.held = []
+
+    def evict(self):
+        """
+        Drop unpinned entries, oldest use first, until the cache fits in
+        max_bytes. Must be called with the cache lock held.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for path in glob(os.path.join(self.path, "*.json")):
+            md5 = os.path.basename(path)[:-len(".json")]
+            entry = self.readEntry(md5)
+            if entry is not None:
+                entries.append( (entry['used'], md5, entry['bytes']) )
+                total += entry['bytes']
+        entries.sort()
+        for used, md5, size in entries:
+            if total <= self.max_bytes:
+                break
+            ref = open(self.entryPath(md5, ".lock"), "a")
+            try:
+                fcntl.flock(ref, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                ref.close()
+                continue #in use
+            os.unlink(self.entryPath(md5, ".json"))
+            shutil.rmtree(self.entryPath(md5), ignore_errors=True)
+            ref.close()
+            total -= size
+            print "extract cache evicted %s" % (md5)
+
+
+class RequestGovernor(object):
+    """
+    Retry and rate policy for DCC web service requests.
+
+    Failed requests are retried with exponential backoff and full jitter, but
+    only for errors that can clear up by themselves (network errors, truncated
+    pages, 408/429/5xx responses). Requests are spaced by a token bucket of
+    'rate' requests per second; when lock_path is set the bucket is kept in
+    that file, so every process on the node shares the same budget.
+    """
+    retryCodes = [408, 429, 500, 502, 503, 504]
+
+    def __init__(self, rate=None, burst=1, lock_path=None, max_retries=5, base_delay=2.0, max_delay=120.0):
+        self.rate = rate
+        self.burst = burst
+        self.lock_path = lock_path
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.last = time.time()
+        self.stats = {}
+
+    def hostStats(self, host):
+        with self.lock:
+            if host not in self.stats:
+                self.stats[host] = { 'requests' : 0, 'retries' : 0, 'failures' : 0, 'throttle_waits' : 0, 'throttle_seconds' : 0.0 }
+            return self.stats[host]
+
+    def isRetryable(self, err):
+        if isinstance(err, HTTPError):
+            return err.code in self.retryCodes
+        return isinstance(err, (IOError, socket.error, httplib.HTTPException, ParseError))
+
+    def backoff(self, attempt, err):
+        if isinstance(err, HTTPError) and err.retry_after is not None:
+            return min(err.retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def takeToken(self, tokens, last):
+        """
+        Refill and draw from the bucket, returns (tokens, last, wait_seconds)
+        """
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def throttle(self, host):
+        if self.rate is None:
+            return
+        stats = self.hostStats(host)
+        while True:
+            with self.lock:
+                if self.lock_path is None:
+                    self.tokens, self.last, wait = self.takeToken(self.tokens, self.last)
+                else:
+                    handle = open(self.lock_path, "a+")
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                    handle.seek(0)
+                    tmp = handle.read().split()
+                    if len(tmp) == 2:
+                        tokens, last = float(tmp[0]), float(tmp[1])
+                    else:
+                        tokens, last = self.burst, time.time()
+                    tokens, last, wait = self.takeToken(tokens, last)
+                    handle.seek(0)
+                    handle.truncate()
+                    handle.write("%f %f\n" % (tokens, last))
+                    handle.flush()
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+                    handle.close()
+            if wait <= 0:
+                return
+            with self.lock:
+                stats['throttle_waits'] += 1
+                stats['throttle_seconds'] += wait
+            time.sleep(wait)
+
+    def call(self, url, func):
+        """
+        Run func(url) under the rate limit, retrying transient failures
+        """
+        host = urlparse(url).hostname
+        stats = self.hostStats(host)
+        attempt = 0
+        while True:
+            self.throttle(host)
+            with self.lock:
+                stats['requests'] += 1
+            try:
+                return func(url)
+            except Exception, e:
+                if not self.isRetryable(e) or attempt >= self.max_retries:
+                    with self.lock:
+                        stats['failures'] += 1
+                    raise
+                delay = self.backoff(attempt, e)
+                logging.warning("Retry %d for %s in %.1fs: %s" % (attempt + 1, url, delay, e))
+                with self.lock:
+                    stats['retries'] += 1
+                attempt += 1
+                time.sleep(delay)
+
+
+class ResponseCache(object):
+    """
+    On disk store of raw DCC web service responses, keyed by the full query URL.
+    Entries older then ttl seconds are refetched, unless the cache is offline,
+    in which case only cached responses are served.
+    """
+    def __init__(self, path, ttl=None, offline=False, suffix=".xml"):
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        self.suffix = suffix
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass #another job created it first
+
+    def getPath(self, url):
+        key = hashlib.md5(url).hexdigest()
+        return os.path.join(self.path, key[:2], key + self.suffix)
+
+    def get(self, url):
+        path = self.getPath(url)
+        if not os.path.exists(path):
+            return None
+        if self.ttl is not None and not self.offline:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+        handle = open(path, "rb")
+        data = handle.read()
+        handle.close()
+        return data
+
+    def put(self, url, data):
+        path = self.getPath(url)
+        dir = os.path.dirname(path)
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                pass #another job created it first
+        #write to a temp name then rename, so parallel jobs never see partial pages
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=dir)
+        handle = os.fdopen(tmp_fd, "wb")
+        handle.write(data)
+        handle.close()
+        os.rename(tmp_path, path)
+
+
 class dccwsItem(object):
     baseURL = "http://tcga-data.nci.nih.gov/tcgadccws/GetXML?query="
+    dataURL = "https://tcga-data.nci.nih.gov"
+    cache = None
+    prefetch = 2
+    governor = RequestGovernor()
 
     def __init__(self):
         self.url = None
             
-    def __iter__(self):
+    def fetchPage(self, url):
+        """
+        Fetch and parse one page of a query response, returning the
+        records on the page and the url of the next page (or None)
+        """
+        cache = dccwsItem.cache
+        if cache is not None:
+            data = cache.get(url)
+            if data is not None:
+                return parseResponse(data)
+            if cache.offline:
+                raise Exception("Offline and no cached response for: %s" % (url))
+        def fetch(url):
+            data = None
+            try:
+                handle = http_session.urlopen(url)
+                data = handle.read()
+                handle.close()
+                return data, parseResponse(data)
+            except ParseError:
+                sys.stderr.write("URL %s : Message Error: %s\n" % (url, data ) )
+                raise
+        data, page = dccwsItem.governor.call(url, fetch)
+        if cache is not None:
+            cache.put(url, data)
+        return page
+
+    def pages(self):
+        """
+        Yield the list of records found on each page of the query response,
+        following 'next' links until the listing is exhausted
+        """
         next = self.url        
         while next != None:
-            retry_count = 3
-            while retry_count > 0:
-                try:
-                    data = None
-                    handle = urllib.urlopen(next)
-                    data = handle.read()
-                    handle.close()
-                    dom = parseString(data)
-                    retry_count = 0
-                except Exception, e:
-                    retry_count -= 1
-                    if retry_count <= 0:
-                        sys.stderr.write("URL %s : Message Error: %s\n" % (next, data ) )
-                        raise e
-                    time.sleep(random.randint(10, 35))
-            # there might not be any archives for a dataset
-            if len(dom.getElementsByTagName('queryResponse')) > 0:
-                response = dom.getElementsByTagName('queryResponse').pop()
-                classList = response.getElementsByTagName('class')
-                for cls in classList:
-                    className = cls.getAttribute("recordNumber")
-                    outData = {}
-                    #aObj = Archive()
-                    for node in cls.childNodes:
-                        nodeName = node.getAttribute("name")
-                        if node.hasAttribute("xlink:href"):
-                            outData[ nodeName ] = node.getAttribute("xlink:href")            
-                        else:
-                            outData[ nodeName ] = getText( node.childNodes )
-                    yield outData
-            if len( dom.getElementsByTagName('next') ) > 0:
-                nextElm = dom.getElementsByTagName('next').pop()
-                next = nextElm.getAttribute( 'xlink:href' )
-            else:
-                next = None
+            records, next = self.fetchPage(next)
+            yield records
+
+    def __iter__(self):
+        if dccwsItem.prefetch > 0:
+            pages = prefetch_iter(self.pages(), dccwsItem.prefetch)
+        else:
+            pages = self.pages()
+        for records in pages:
+            for outData in records:
+                yield outData
+
+
+XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+
+def localName(tag):
+    if tag.startswith("{"):
+        return tag.split("}", 1)[1]
+    return tag
+
+def iterResponse(handle):
+    """
+    Incrementally parse a queryResponse document, yielding ('class', record)
+    as soon as each record closes, and ('next', url) for paging links
+    """
+    inResponse = 0
+    for event, elem in iterparse(handle, events=("start", "end")):
+        name = localName(elem.tag)
+        if event == "start":
+            if name == "queryResponse":
+                inResponse += 1
+        elif name == "class" and inResponse:
+            outData = {}
+            for node in elem:
+                href = node.get(XLINK_HREF)
+                if href is not None:
+                    outData[ node.get("name") ] = href
+                else:
+                    outData[ node.get("name") ] = (node.text or '') + ''.join( c.tail or '' for c in node )
+            yield "class", outData
+            #records are not needed once emitted, keep the tree from growing
+            elem.clear()
+        elif name == "queryResponse":
+            inResponse -= 1
+        elif name == "next":
+            yield "next", elem.get(XLINK_HREF, '')
+
+def parseResponse(data):
+    """
+    Parse one page of a query response, returns (records, next_url)
+    """
+    records = []
+    next = None
+    for event, value in iterResponse(StringIO(data)):
+        if event == "class":
+            records.append(value)
+        else:
+            next = value
+    return records, next
+
+def parseResponseDOM(data):
+    """
+    Reference DOM based version of parseResponse
+    """
+    dom = parseString(data)
+    records = []
+    # there might not be any archives for a dataset
+    if len(dom.getElementsByTagName('queryResponse')) > 0:
+        response = dom.getElementsByTagName('queryResponse').pop()
+        classList = response.getElementsByTagName('class')
+        for cls in classList:
+            outData = {}
+            for node in cls.childNodes:
+                nodeName = node.getAttribute("name")
+                if node.hasAttribute("xlink:href"):
+                    outData[ nodeName ] = node.getAttribute("xlink:href")            
+                else:
+                    outData[ nodeName ] = getText( node.childNodes )
+            records.append(outData)
+    next = None
+    if len( dom.getElementsByTagName('next') ) > 0:
+        nextElm = dom.getElementsByTagName('next').pop()
+        next = nextElm.getAttribute( 'xlink:href' )
+    return records, next
+
+
+def prefetch_iter(source, depth):
+    """
+    Run the source iterator on a background thread, buffering at most 'depth'
+    items ahead of the consumer. Exceptions raised by the source are re-raised
+    in the consuming thread.
+    """
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in source:
+                if not put( (True, item) ):
+                    return
+            put( (False, None) )
+        except Exception:
+            put( (False, sys.exc_info()) )
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if not ok:
+                if item is not None:
+                    raise item[0], item[1], item[2]
+                return
+            yield item
+    finally:
+        #consumer finished or abandoned the generator, let the producer exit
+        stop.set()
 
 
 class CustomQuery(dccwsItem):
@@ -92,6 +1089,151 @@ class CustomQuery(dccwsItem):
             self.url = dccwsItem.baseURL + query
 
     
+class LinkResolver(object):
+    """
+    Process wide memo of xlink entity lookups (platform, disease, center...).
+    Keeps the last maxsize resolved links in memory, and when a cache is
+    attached, on disk as well. Entity records rarely change, so the disk
+    copies have no ttl.
+    """
+    def __init__(self, maxsize=512, cache=None):
+        self.maxsize = maxsize
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.memo = OrderedDict()
+
+    def resolve(self, url):
+        with self.lock:
+            if url in self.memo:
+                out = self.memo.pop(url)
+                self.memo[url] = out
+                return out
+        out = None
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                out = json.loads(data)
+        if out is None:
+            out = list(CustomQuery(url))
+            if self.cache is not None:
+                self.cache.put(url, json.dumps(out))
+        with self.lock:
+            self.memo[url] = out
+            while len(self.memo) > self.maxsize:
+                self.memo.popitem(last=False)
+        return out
+
+link_resolver = LinkResolver()
+
+
+class ArchiveCatalog(object):
+    """
+    Local sqlite index of the latest DCC Archive records, plus the platform,
+    disease, center and archive type entities they link to. Filled by
+    'tcgaImport.py catalog sync', after which archive lookups are answered
+    without paging through the DCC web service.
+    """
+    fields = [ 'baseName', 'platform', 'platform_alias', 'disease', 'center', 'archive_type', 'deployLocation', 'addedDate' ]
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS archive (%s, record TEXT)" % (", ".join( "%s TEXT" % (f) for f in self.fields )))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entity (url TEXT PRIMARY KEY, record TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        for f in [ 'baseName', 'platform', 'platform_alias', 'disease', 'center', 'archive_type' ]:
+            self.conn.execute("CREATE INDEX IF NOT EXISTS archive_%s ON archive (%s)" % (f, f))
+        self.conn.commit()
+
+    def get(self, url):
+        for row in self.conn.execute("SELECT record FROM entity WHERE url=?", (url,)):
+            return row[0]
+        return None
+
+    def put(self, url, data):
+        self.conn.execute("INSERT OR REPLACE INTO entity (url, record) VALUES (?,?)", (url, data))
+        self.conn.commit()
+
+    def entityValue(self, url, field):
+        if url is None:
+            return None
+        out = None
+        for e in link_resolver.resolve(url):
+            out = e.get(field, None)
+        return out
+
+    def sync(self):
+        rows = []
+        entities = {}
+        for e in CustomQuery("Archive[@isLatest=1]"):
+            for link in [ 'platform', 'disease', 'center', 'archiveType' ]:
+                if link in e:
+                    entities[ e[link] ] = link_resolver.resolve(e[link])
+            if 'disease' in e:
+                for d in entities[ e['disease'] ]:
+                    if 'tissueCollection' in d:
+                        entities[ d['tissueCollection'] ] = link_resolver.resolve(d['tissueCollection'])
+            rows.append( (
+                e['baseName'],
+                self.entityValue(e.get('platform'), 'name'),
+                self.entityValue(e.get('platform'), 'alias'),
+                self.entityValue(e.get('disease'), 'abbreviation'),
+                self.entityValue(e.get('center'), 'name'),
+                self.entityValue(e.get('archiveType'), 'type'),
+                e['deployLocation'],
+                e['addedDate'],
+                json.dumps(e)
+            ) )
+        #swap in the new listing in one transaction, so readers never see a partial catalog
+        self.conn.execute("DELETE FROM archive")
+        self.conn.executemany("INSERT INTO archive (%s, record) VALUES (%s)" % (", ".join(self.fields), ",".join( ["?"] * (len(self.fields)+1) )), rows)
+        self.conn.executemany("INSERT OR REPLACE INTO entity (url, record) VALUES (?,?)", [ (u, json.dumps(r)) for u, r in entities.items() ])
+        self.conn.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('synced', ?)", (datetime.datetime.now().isoformat(),))
+        self.conn.commit()
+        return len(rows)
+
+    def query(self, **filters):
+        """
+        Archive records matching the field filters (see ArchiveCatalog.fields)
+        """
+        where = []
+        values = []
+        for k, v in filters.items():
+            if k not in self.fields:
+                raise Exception("Unknown catalog field: %s" % (k))
+            if v is not None:
+                where.append("%s=?" % (k))
+                values.append(v)
+        sql = "SELECT record FROM archive"
+        if len(where):
+            sql += " WHERE " + " AND ".join(where)
+        for row in self.conn.execute(sql + " ORDER BY rowid", values):
+            yield json.loads(row[0])
+
+    def diseases(self):
+        for row in self.conn.execute("SELECT DISTINCT disease FROM archive WHERE disease IS NOT NULL ORDER BY disease"):
+            yield row[0]
+
+    def info(self):
+        out = {}
+        for row in self.conn.execute("SELECT key, value FROM info"):
+            out[row[0]] = row[1]
+        for row in self.conn.execute("SELECT count(*), count(DISTINCT baseName) FROM archive"):
+            out['archives'], out['basenames'] = row
+        return out
+
+catalog = None
+
+def archive_query(query, **filters):
+    """
+    Latest archives matching a DCC query string. When a local catalog is
+    loaded, the equivalent field filters are used to answer from it instead.
+    """
+    if catalog is not None:
+        return catalog.query(**filters)
+    return CustomQuery(query)
+
+
 def getText(nodelist):
     rc = []
     for node in nodelist:
@@ -128,6 +1270,26 @@ class BuildConf:
         self.metapath = opts.metapath
         self.errorpath = opts.errorpath
         self.clinical_type = opts.clinical_type
+        self.download_workers = opts.download_workers
+        self.stream = opts.stream
+        self.no_extract = opts.no_extract
+        self.extract_cache = opts.extract_cache
+        self.extract_cache_size = opts.extract_cache_size
+        self.extract_workers = opts.extract_workers
+        self.scan_workers = opts.scan_workers
+        self.sort_workers = opts.sort_workers
+        self.memory_budget = opts.memory_budget
+        self.spill_dir = opts.spill_dir
+        self.columnar = opts.columnar
+        self.float32_matrix = opts.float32_matrix
+        self.binary_matrix = opts.binary_matrix
+        if self.float32_matrix and numpy is None:
+            raise Exception("Float32 matrices need the numpy module, which is not installed")
+        self.spill_codec = None
+        if opts.spill_codec != "none":
+            if opts.spill_codec not in SPILL_CODECS:
+                raise Exception("Spill codec %s not available (is the %s module installed?)" % (opts.spill_codec, opts.spill_codec))
+            self.spill_codec = opts.spill_codec
 
         self.clinical_type_map = {}
         for t, path, meta in opts.out_clinical:
@@ -141,27 +1303,37 @@ class BuildConf:
                 if len(tmp) == 2:
                     self.uuid_table[tmp[0]] = tmp[1]
 
-    def getURLPath(self, url):
+    def getMirrorPath(self, url):
         if self.mirror is None:
             print "Define mirror location"
             sys.exit(1)
-
-        src = url # "https://tcga-data.nci.nih.gov/" + url
         path = urlparse(url).path
-        dst = os.path.join(self.mirror, re.sub("^/", "", path))
-        dir = os.path.dirname(dst)
-        if not os.path.exists(dir):
-            print "mkdir", dir
-            os.makedirs(dir)
+        return os.path.join(self.mirror, re.sub("^/", "", path))
+
+    def getURLPath(self, url):
+        dst = self.getMirrorPath(url)
         if not os.path.exists( dst ):
             if self.download or self.download_only:    
-                print "download %s to %s" % (src, dst)
-                urllib.urlretrieve(src, dst)
+                ArchiveDownloader(workers=1).run( [ (url, dst) ] )
             else:
                 raise Exception("Missing source file: %s" % url)
         return dst
 
-
+    def downloadAll(self, urls, extract_dir=None, accept=None, stats=None):
+        """
+        Fetch every url missing from the mirror, download_workers at a time.
+        With extract_dir, the downloads are also unpacked there as they stream
+        in. Returns the urls that were fetched.
+        """
+        jobs = []
+        for url in urls:
+            dst = self.getMirrorPath(url)
+            if not os.path.exists(dst):
+                jobs.append( (url, dst) )
+        if len(jobs) and (self.download or self.download_only):
+            ArchiveDownloader(workers=self.download_workers).run(jobs, extract_dir, accept, stats)
+            return [ url for url, dst in jobs ]
+        return []
 
 
     def buildRequest(self):
@@ -219,32 +1391,32 @@ def getBaseBuildConf(basename, platform, mirror):
                 'disease' : 'cancer',
                 'provenance' : { 'name' : 'tcgaImport', 'used' : [] }
             }            
-            for e2 in CustomQuery(e['platform']):
+            for e2 in link_resolver.resolve(e['platform']):
                 platform = e2['name']
                 meta['platform'] = e2['name']
                 meta['annotations']['platformTitle'] = e2['displayName']
-            for e2 in CustomQuery(e['disease']):
+            for e2 in link_resolver.resolve(e['disease']):
                 meta['annotations']['acronym'] = e2['abbreviation']
                 meta['annotations']['diseaseTitle'] = e2['name']
-                for e3 in CustomQuery(e2['tissueCollection']):
+                for e3 in link_resolver.resolve(e2['tissueCollection']):
                     meta['tissue'] = e3['name']
-            for e2 in CustomQuery(e['center']):
+            for e2 in link_resolver.resolve(e['center']):
                 meta['annotations']['centerTitle'] = e2['displayName']
                 meta['annotations']['center'] = e2['name']
                 meta['annotations']['basename'] = basename
         meta['provenance']['used'].append(
             {
-                'url' : "https://tcga-data.nci.nih.gov" + e['deployLocation'],
+                'url' : dccwsItem.dataURL + e['deployLocation'],
                 "concreteType": "org.sagebionetworks.repo.model.provenance.UsedURL"
             }
         )
         urls[ mirror + e['deployLocation'] ] = platform
 
     logging.debug("TCGA Query for mage-tab: %s" % (basename))
-    q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename))
+    q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename), baseName=basename, archive_type="mage-tab")
     for e in q:
         dates.append( datetime.datetime.strptime( e['addedDate'], "%m-%d-%Y" ) )
-        q2 = CustomQuery(e['platform'])
+        q2 = link_resolver.resolve(e['platform'])
         platform = None
         for e2 in q2:
             logging.debug("%s" % (e2))
@@ -252,7 +1424,7 @@ def getBaseBuildConf(basename, platform, mirror):
         meta['provenance']['used'].append( 
             {
                 "concreteType": "org.sagebionetworks.repo.model.provenance.UsedURL",
-                "url" : "https://tcga-data.nci.nih.gov" + e['deployLocation'] 
+                "url" : dccwsItem.dataURL + e['deployLocation'] 
             }
         )
         urls[ mirror + e['deployLocation'] ] = platform
@@ -270,16 +1442,375 @@ def getBaseBuildConf(basename, platform, mirror):
 
 
 
-class TableReader:
+SPILL_MAGIC = "TCGASPL3"
+#uncompressed bytes of records per compressed block
+SPILL_BLOCK = 262144
+
+#spill block codecs, name : (compress, decompress)
+SPILL_CODECS = { "zlib" : (lambda data: zlib.compress(data, 1), zlib.decompress) }
+if lz4block is not None:
+    SPILL_CODECS["lz4"] = (lz4block.compress, lz4block.decompress)
+
+def spill_schema(data):
+    """
+    Field schema for a port, taken from its first record: the field names,
+    in the dict's own order, when the record is a flat dict of strings,
+    otherwise None
+    """
+    if not isinstance(data, dict):
+        return None
+    for value in data.itervalues():
+        if not isinstance(value, basestring):
+            return None
+    return tuple(data)
+
+
+class SpillWriter:
+    """
+    Binary spill file for emitted (key, data) records. After the magic, the
+    port's field schema and the codec name, each record is
+    <key length><payload length><key><payload>, lengths as little endian
+    uint32. Records with exactly the schema's fields, in the same order, are
+    stored as their values, NUL separated ('J') or as a marshalled tuple when
+    a value is unicode or holds a NUL ('T'). Tuples are marshalled ('M'), and
+    anything else is stored as its JSON text ('S').
+
+    With a codec, records are gathered into blocks of about SPILL_BLOCK bytes,
+    each written as <compressed length><raw length><compressed block>.
+    """
+    def __init__(self, path, codec=None):
+        self.handle = open(path, "wb")
+        self.schema = False
+        self.codec = codec
+        self.compress = None
+        if codec is not None:
+            self.compress = SPILL_CODECS[codec][0]
+        self.block = []
+        self.blockSize = 0
+
+    def writeHeader(self, schema):
+        self.schema = schema
+        header = marshal.dumps( (schema, self.codec) )
+        self.handle.write(SPILL_MAGIC + struct.pack("<I", len(header)) + header)
+
+    def put(self, frame):
+        if self.compress is None:
+            self.handle.write(frame)
+            return
+        self.block.append(frame)
+        self.blockSize += len(frame)
+        if self.blockSize >= SPILL_BLOCK:
+            self.writeBlock()
+
+    def writeBlock(self):
+        if len(self.block):
+            data = self.compress("".join(self.block))
+            self.handle.write(struct.pack("<II", len(data), self.blockSize) + data)
+            self.block = []
+            self.blockSize = 0
+
+    def encode(self, data):
+        if self.schema is not None and isinstance(data, dict) and tuple(data) == self.schema:
+            values = data.values()
+            joined = "\0".join(values)
+            if type(joined) is str and joined.count("\0") == len(values) - 1:
+                return "J" + joined
+            return "T" + marshal.dumps(tuple(values))
+        if isinstance(data, tuple):
+            return "M" + marshal.dumps(data)
+        return "S" + json.dumps(data)
+
+    def write(self, key, data):
+        if self.schema is False:
+            self.writeHeader(spill_schema(data))
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        payload = self.encode(data)
+        self.put(struct.pack("<II", len(key), len(payload)) + key + payload)
+
+    def writeRaw(self, key, payload):
+        self.put(struct.pack("<II", len(key), len(payload)) + key + payload)
+
+    def flush(self):
+        if self.schema is not False:
+            self.writeBlock()
+        self.handle.flush()
+
+    def close(self):
+        if self.schema is False:
+            self.writeHeader(None)
+        self.writeBlock()
+        self.handle.close()
+
+
+def decode_spill(schema, payload):
+    if payload[0] == "J":
+        return dict(zip(schema, payload[1:].split("\0")))
+    if payload[0] == "T":
+        return dict(zip(schema, marshal.loads(payload[1:])))
+    if payload[0] == "S":
+        return json.loads(payload[1:])
+    return marshal.loads(payload[1:])
+
+
+#'"field": ' prefixes of the JSON text of each schema's records
+_order_prefixes = {}
+
+def spill_order(schema, payload):
+    """
+    Sort order of records that share a key: the JSON text they were spilled
+    as before the binary format, when '<key>\t<json>' lines were sorted
+    bytewise. Built from the values of 'J' and 'T' records, in field order.
+    Tuples ('M') have no JSON form and compare by their encoding.
+    """
+    tag = payload[0]
+    if tag == "S":
+        return payload[1:]
+    if tag == "J":
+        values = payload[1:].split("\0")
+    elif tag == "T":
+        values = marshal.loads(payload[1:])
+    else:
+        return payload
+    if not len(schema):
+        return "{}"
+    prefixes = _order_prefixes.get(schema)
+    if prefixes is None:
+        prefixes = [ ", %s: " % (json.dumps(f)) for f in schema ]
+        prefixes[0] = "{" + prefixes[0][2:]
+        _order_prefixes[schema] = prefixes
+    return "".join( [ p + encode_basestring_ascii(v) for p, v in zip(prefixes, values) ] ) + "}"
+
+
+def spill_convert(schema, payload):
+    """
+    Re-encode a payload written under schema, for a file without one
+    """
+    if payload[0] in "JT":
+        return "S" + spill_order(schema, payload)
+    return payload
+
+
+class SpillReader:
     def __init__(self, path):
+        self.handle = open(path, "rb")
+        if self.handle.read(len(SPILL_MAGIC)) != SPILL_MAGIC:
+            raise Exception("Not a spill file: %s" % (path))
+        size, = struct.unpack("<I", self.handle.read(4))
+        self.schema, self.codec = marshal.loads(self.handle.read(size))
+        if self.codec is not None and self.codec not in SPILL_CODECS:
+            raise Exception("Spill file %s needs the %s codec, which is not installed" % (path, self.codec))
+
+    def raw(self):
+        """
+        (key, payload) pairs, without decoding the payload
+        """
+        if self.codec is not None:
+            for record in self.rawBlocks():
+                yield record
+            return
+        read = self.handle.read
+        unpack = struct.unpack
+        while True:
+            head = read(8)
+            if len(head) < 8:
+                break
+            klen, plen = unpack("<II", head)
+            body = read(klen + plen)
+            yield body[:klen], body[klen:]
+        self.handle.close()
+
+    def rawBlocks(self):
+        read = self.handle.read
+        unpack_from = struct.unpack_from
+        decompress = SPILL_CODECS[self.codec][1]
+        while True:
+            head = read(8)
+            if len(head) < 8:
+                break
+            size, raw_size = struct.unpack("<II", head)
+            block = decompress(read(size))
+            offset = 0
+            end = len(block)
+            while offset < end:
+                klen, plen = unpack_from("<II", block, offset)
+                offset += 8
+                yield block[offset:offset + klen], block[offset + klen:offset + klen + plen]
+                offset += klen + plen
+        self.handle.close()
+
+    def decode(self, payload):
+        return decode_spill(self.schema, payload)
+
+    def rawSize(self):
+        """
+        Uncompressed size of the records, read from the block headers
+        """
+        if self.codec is None:
+            size = os.fstat(self.handle.fileno()).st_size - self.handle.tell()
+        else:
+            size = 0
+            while True:
+                head = self.handle.read(8)
+                if len(head) < 8:
+                    break
+                block_size, raw_size = struct.unpack("<II", head)
+                size += raw_size
+                self.handle.seek(block_size, 1)
+        self.handle.close()
+        return size
+
+    def __iter__(self):
+        for key, payload in self.raw():
+            yield key, self.decode(payload)
+
+    def ordered(self):
+        """
+        (key, spill_order, value) records
+        """
+        for key, payload in self.raw():
+            yield key, spill_order(self.schema, payload), self.decode(payload)
+
+
+#in memory size of spilled records held as grouped payloads, relative to their encoded size
+HASH_EXPANSION = 3
+
+#rough python object overhead of an in-memory (key, order, payload) record
+SORT_RECORD_OVERHEAD = 120
+#most runs merged at once, to keep the number of open files down
+SORT_MERGE_FANIN = 128
+
+def write_sort_run(records, schema, run_dir, codec=None):
+    """
+    records are (key, spill_order, payload)
+    """
+    records.sort()
+    fd, path = tempfile.mkstemp(dir=run_dir, suffix=".run")
+    os.close(fd)
+    out = SpillWriter(path, codec)
+    out.writeHeader(schema)
+    for key, order, payload in records:
+        out.writeRaw(key, payload)
+    out.close()
+    return path
+
+def sort_runs(job):
+    """
+    Cut one spill file into sorted runs of at most 'budget' bytes in memory.
+    Records are re-encoded as JSON text when the file's schema isn't the one
+    the output uses.
+    """
+    path, schema, run_dir, budget, codec = job
+    reader = SpillReader(path)
+    convert = reader.schema != schema
+    runs = []
+    records = []
+    size = 0
+    for key, payload in reader.raw():
+        if convert:
+            payload = spill_convert(reader.schema, payload)
+        order = spill_order(schema, payload)
+        records.append( (key, order, payload) )
+        size += len(key) + len(order) + len(payload) + SORT_RECORD_OVERHEAD
+        if size >= budget:
+            runs.append(write_sort_run(records, schema, run_dir, codec))
+            records = []
+            size = 0
+    if len(records) or not len(runs):
+        runs.append(write_sort_run(records, schema, run_dir, codec))
+    return runs
+
+
+def ordered_records(reader, schema):
+    for key, payload in reader.raw():
+        yield key, spill_order(schema, payload), payload
+
+
+class ExternalSorter:
+    """
+    Sorts spill files by key, and records with the same key by spill_order,
+    comparing raw bytes: the order 'sort -k 1' gave the JSON spill lines in
+    the C locale, whatever the locale. Inputs are cut into sorted runs that fit
+    in memory_budget bytes, in parallel across inputs, and the runs are
+    k-way merged. Runs and output are compressed with codec, if given.
+    """
+    def __init__(self, memory_budget, spill_dir, workers=1, codec=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.workers = workers
+        self.codec = codec
+
+    def mergeRuns(self, runs, schema, dst):
+        readers = [ ordered_records(SpillReader(run), schema) for run in runs ]
+        out = SpillWriter(dst, self.codec)
+        out.writeHeader(schema)
+        for key, order, payload in heapq.merge(*readers):
+            out.writeRaw(key, payload)
+        out.close()
+        for run in runs:
+            os.unlink(run)
+
+    def sort(self, paths, dst):
+        schemas = set()
+        for path in paths:
+            schemas.add(SpillReader(path).schema)
+        #inputs with different schemas are merged untyped
+        schema = None
+        if len(schemas) == 1:
+            schema = schemas.pop()
+        run_dir = tempfile.mkdtemp(dir=self.spill_dir, prefix="sort.")
+        try:
+            workers = max(1, min(self.workers, len(paths)))
+            jobs = [ (path, schema, run_dir, self.memory_budget / workers, self.codec) for path in paths ]
+            if workers > 1:
+                pool = multiprocessing.Pool(workers)
+                try:
+                    results = pool.map(sort_runs, jobs, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = map(sort_runs, jobs)
+            runs = []
+            for r in results:
+                runs.extend(r)
+            while len(runs) > SORT_MERGE_FANIN:
+                fd, merged = tempfile.mkstemp(dir=run_dir, suffix=".run")
+                os.close(fd)
+                self.mergeRuns(runs[:SORT_MERGE_FANIN], schema, merged)
+                runs = runs[SORT_MERGE_FANIN:] + [merged]
+            if len(runs) == 1:
+                os.rename(runs[0], dst)
+            else:
+                self.mergeRuns(runs, schema, dst)
+        finally:
+            shutil.rmtree(run_dir)
+
+
+class TableReader:
+    def __init__(self, path, ordered=False):
         self.path = path
+        self.ordered = ordered
     
     def __iter__(self):
         if self.path is not None and os.path.exists(self.path):
             handle = open(self.path)
+            if handle.read(len(SPILL_MAGIC)) == SPILL_MAGIC:
+                handle.close()
+                if self.ordered:
+                    for record in SpillReader(self.path).ordered():
+                        yield record
+                    return
+                for key, value in SpillReader(self.path):
+                    yield key, value
+                return
+            handle.seek(0)
             for line in handle:
                 tmp = line.rstrip().split("\t")
-                yield tmp[0], json.loads(tmp[1])
+                if self.ordered:
+                    yield tmp[0], tmp[1], json.loads(tmp[1])
+                else:
+                    yield tmp[0], json.loads(tmp[1])
             handle.close()
 
 
@@ -289,6 +1820,7 @@ class TableReader:
 
 class FileImporter:
     dataSubTypes = {}
+    parallelScan = True
     
     excludes = [
          "MANIFEST.txt$",
@@ -304,66 +1836,255 @@ class FileImporter:
     def __init__(self, config, build_req):
         self.config = config
         self.build_req = build_req
+        self.archives = []
+        self.members = {}
+        self.scan_dirs = None
+        self.extract_cache = None
+        self.exclude_re = None
+        self.include_re = None
+        self.inventory = None
+        self.shard = None
+        self.columnFiles = 0
         
     def extractTars(self):  
         if not os.path.exists(self.config.workdir_base):
             os.makedirs(self.config.workdir_base)      
         self.work_dir = tempfile.mkdtemp(dir=self.config.workdir_base)
+        urls = [ record['url'] for record in self.build_req['provenance']['used'] ]
+        if self.config.no_extract:
+            #members are read straight out of the mirror tarballs by scanArchives
+            self.config.downloadAll(urls)
+            self.archives = [ self.config.getURLPath(url) for url in urls ]
+            return
+        if self.config.extract_cache is not None:
+            self.config.downloadAll(urls)
+            if self.config.download_only:
+                return
+            max_bytes = None
+            if self.config.extract_cache_size is not None:
+                max_bytes = self.config.extract_cache_size * 1048576
+            self.extract_cache = ExtractCache(self.config.extract_cache, max_bytes)
+            self.scan_dirs = [ self.extract_cache.acquire(self.config.getURLPath(url)) for url in urls ]
+            return
         print "Extract to ", self.work_dir
-        for record in self.build_req['provenance']['used']:
-            url = record['url']
-            path = self.config.getURLPath(url)
-            if not self.config.download_only:
-                subprocess.check_call([ "tar", "xzf", path, "-C", self.work_dir])#, stderr=sys.stdout)
+        stats = ExtractStats()
+        start = time.time()
+        streamed = []
+        if self.config.stream and not self.config.download_only:
+            streamed = self.config.downloadAll(urls, self.work_dir, self.acceptMember, stats)
+        else:
+            self.config.downloadAll(urls)
+        paths = [ self.config.getURLPath(url) for url in urls ]
+        if self.config.download_only:
+            return
+        print "stage download: %.1fs" % (time.time() - start)
+        #one subdirectory per archive, so same named members never overwrite each other
+        self.scan_dirs = [ os.path.join(self.work_dir, archiveDirName(path)) for path in paths ]
+        jobs = []
+        for url, path, dest in zip(urls, paths, self.scan_dirs):
+            if url not in streamed:
+                jobs.append( (path, dest) )
+        start = time.time()
+        for counts, write_seconds in extract_archives(jobs, self.acceptMember, self.config.extract_workers):
+            stats.merge(counts, write_seconds)
+        print "stage extract (%d archives, %d workers): %s" % (len(jobs), self.config.extract_workers, stats.report(time.time() - start))
+
+    def acceptMember(self, name):
+        """
+        Only archive members that the scan will read are worth extracting:
+        MAGE-TAB files, and files some dataSubType would include
+        """
+        if self.isMage(name):
+            return True
+        name = os.path.basename(name)
+        #the walk skips hidden files, so they are never read
+        if name.startswith(".") or self.checkExclude(name):
+            return False
+        for dsubtype in self.dataSubTypes:
+            info = self.dataSubTypes[dsubtype]
+            if 'fileInclude' in info and not re.match(info['fileInclude'], name):
+                continue
+            if 'fileExclude' in info and re.match(info['fileExclude'], name):
+                continue
+            return True
+        return False
         
     def run(self):        
         self.extractTars()
         if self.config.download_only:
             return
-        #scan the magetab
-        self.out = {}
-        self.ext_meta = {}
-        self.scandirs(self.work_dir, None)
-        for o in self.out:
-            self.out[o].close()
+        dataSubTypes = []
         for dsubtype in self.dataSubTypes:
-            print "Extracting: ", dsubtype
             filterInclude = None
             filterExclude = None
             if 'fileInclude' in self.dataSubTypes[dsubtype]:
                 filterInclude = re.compile(self.dataSubTypes[dsubtype]['fileInclude'])
             if 'fileExclude' in self.dataSubTypes[dsubtype]:
                 filterExclude = re.compile(self.dataSubTypes[dsubtype]['fileExclude'])
+            dataSubTypes.append( (dsubtype, filterInclude, filterExclude) )
+        #files no dataSubType includes are dropped by a single match
+        includes = [ self.dataSubTypes[d].get('fileInclude') for d in self.dataSubTypes ]
+        if len(includes) and None not in includes:
+            self.include_re = combine_patterns(includes)
+        #one pass over the files scans the magetab and feeds every dataSubType
+        start = time.time()
+        self.out = {}
+        self.errors = []
+        self.ext_meta = {}
+        self.mage_meta = {}
+        self.scanSource(dataSubTypes)
+        for o in self.out:
+            self.out[o].close()
+        print "stage scan: %.1fs" % (time.time() - start)
+        for dsubtype in self.dataSubTypes:
+            print "Extracting: ", dsubtype
             self.inc = 0
             self.errors = []
             self.ext_meta = {}
             self.out = {}
-            self.scandirs(self.work_dir, dsubtype, filterInclude=filterInclude, filterExclude=filterExclude)
-            for o in self.out:
-                self.out[o].close()
+            start = time.time()
             self.fileBuild(dsubtype)
+            print "stage %s build: %.1fs" % (dsubtype, time.time() - start)
+        if self.extract_cache is not None:
+            self.extract_cache.release()
         shutil.rmtree(self.work_dir)       
     
     def checkExclude( self, name ):
-        for e in self.excludes:
-            if re.search( e, name ):
-                return True
-        return False
+        if self.exclude_re is None:
+            self.exclude_re = combine_patterns(self.excludes)
+        return self.exclude_re.search(name) is not None
     
-    def scandirs(self, path, dataSubType, filterInclude=None, filterExclude=None):
-        if os.path.isdir(path):
-            for a in glob(os.path.join(path, "*")):
-                self.scandirs(a, dataSubType, filterInclude, filterExclude)
+    def scanSource(self, dataSubTypes):
+        """
+        dataSubTypes is a list of (dataSubType, filterInclude, filterExclude)
+        """
+        if self.config.no_extract:
+            if self.parallelScan and self.config.scan_workers > 1 and len(self.archives) > 1:
+                #an archive can only be read as one stream, so its MAGE-TAB members
+                #are scanned in the worker too. Their targets go to the worker's
+                #spill shards like any other record, and the idf/DESCRIPTION values
+                #mageScan keeps are never used by fileBuild.
+                self.scanParallel( [ ("scanArchives", ([archive], dataSubTypes)) for archive in self.archives ] )
+            else:
+                self.scanArchives(self.archives, dataSubTypes)
+        elif self.scan_dirs is not None:
+            self.scandirs(self.scan_dirs, dataSubTypes)
         else:
-            name = os.path.basename(path)
+            self.scandirs([self.work_dir], dataSubTypes)
+
+    def scandirs(self, paths, dataSubTypes):
+        self.inventory = FileInventory(paths)
+        jobs = []
+        for path, size in self.inventory:
             if self.isMage(path):
-                if dataSubType is None:
-                    self.mageScan(path)
+                #MAGE-TAB files are scanned here, in the parent
+                self.scanFile(path, dataSubTypes)
             else:
-                if dataSubType is not None:
-                    if not self.checkExclude(name):
-                        if (filterInclude is None or filterInclude.match(name)) and (filterExclude is None or not filterExclude.match(name)):
-                            self.fileScan(path, dataSubType)
+                matched = self.matchDataSubTypes(path, dataSubTypes)
+                if len(matched):
+                    jobs.append( (size, (path, matched)) )
+        if self.parallelScan and self.config.scan_workers > 1 and len(jobs) > 1:
+            #several shards per worker, so an unlucky split doesn't leave workers idle
+            shards = balance_shards(jobs, self.config.scan_workers * 4)
+            self.scanParallel( [ ("scanFiles", (shard,)) for shard in shards ] )
+        else:
+            self.scanFiles( [ job for size, job in jobs ] )
+
+    def scanFiles(self, jobs):
+        for path, matched in jobs:
+            self.fileScanMulti(path, matched)
+
+    def scanParallel(self, tasks):
+        """
+        Run (method, args) scan tasks over a pool of scan_workers processes.
+        Each task emits into its own shard of the spill files, merged back by
+        sortPort.
+        """
+        global _scan_importer
+        #forked workers must not inherit unwritten spill or stdout buffers
+        for o in self.out:
+            self.out[o].flush()
+        sys.stdout.flush()
+        _scan_importer = self
+        pool = multiprocessing.Pool(min(self.config.scan_workers, len(tasks)))
+        try:
+            pool.map(scan_shard, [ (i, method, args) for i, (method, args) in enumerate(tasks) ], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def scanArchives(self, archives, dataSubTypes):
+        """
+        Scan the members of each mirror tarball as they stream out of the
+        archive, without writing them to disk. Scanners see a path of the
+        form <archive>/<member name>, and get its handle from openFile.
+        """
+        for archive in archives:
+            tar = tarfile.open(archive, "r|gz")
+            for member in tar:
+                if not member.isfile() or not self.acceptMember(member.name):
+                    continue
+                path = os.path.join(archive, member.name)
+                self.members = { path : tar.extractfile(member) }
+                try:
+                    self.scanFile(path, dataSubTypes)
+                finally:
+                    self.members = {}
+            tar.close()
+
+    def scanFile(self, path, dataSubTypes):
+        if self.isMage(path):
+            #MAGE-TAB metadata is kept out of the ext_meta the dataSubType scans see
+            ext_meta = self.ext_meta
+            self.ext_meta = self.mage_meta
+            self.mageScan(path)
+            self.ext_meta = ext_meta
+        else:
+            matched = self.matchDataSubTypes(path, dataSubTypes)
+            if len(matched):
+                self.fileScanMulti(path, matched)
+
+    def matchDataSubTypes(self, path, dataSubTypes):
+        name = os.path.basename(path)
+        if self.checkExclude(name):
+            return []
+        if self.include_re is not None and not self.include_re.match(name):
+            return []
+        matched = []
+        for dataSubType, filterInclude, filterExclude in dataSubTypes:
+            if (filterInclude is None or filterInclude.match(name)) and (filterExclude is None or not filterExclude.match(name)):
+                matched.append(dataSubType)
+        return matched
+
+    def fileScanMulti(self, path, dataSubTypes):
+        """
+        Scan one file for every dataSubType that wants it. Importers that can
+        parse a file once and emit for all of them override this; by default
+        fileScan is called per dataSubType.
+        """
+        if len(dataSubTypes) > 1 and path in self.members:
+            #a tar stream can only be read once, buffer it for the repeat scans
+            data = self.members[path].read()
+            for dataSubType in dataSubTypes:
+                self.members[path] = StringIO(data)
+                self.fileScan(path, dataSubType)
+            return
+        for dataSubType in dataSubTypes:
+            self.fileScan(path, dataSubType)
+
+    def openFile(self, path, mode="r"):
+        """
+        Open a file handed to mageScan/fileScan. When scanning archives in
+        place, the handle reads the member directly from the tar stream.
+        """
+        if path in self.members:
+            if "U" in mode:
+                #tar members have no universal newline mode, translate CR and
+                #CRLF line ends here (only small MAGE-TAB files are read so)
+                data = self.members[path].read()
+                return StringIO(data.replace("\r\n", "\n").replace("\r", "\n"))
+            return self.members[path]
+        return open(path, mode)
                         
     def isMage(self, path):
         if path.endswith( '.sdrf.txt' ) or path.endswith( '.idf.txt' ) or path.endswith("DESCRIPTION.txt"):
@@ -372,13 +2093,99 @@ class FileImporter:
     
     def emit(self, key, data, port):
         if port not in self.out:
-            self.out[port] = open(self.work_dir + "/" + port, "w")
-        self.out[port].write( "%s\t%s\n" % (key, json.dumps(data)))
+            if self.shard is None:
+                self.out[port] = SpillWriter(self.work_dir + "/" + port, self.config.spill_codec)
+            else:
+                self.out[port] = SpillWriter(self.work_dir + "/%s.shard%d" % (port, self.shard), self.config.spill_codec)
+        self.out[port].write(key, data)
+
+    def portPaths(self, port):
+        """
+        Spill file of a port plus the shards written by scan workers
+        """
+        paths = glob(os.path.join(self.work_dir, port + ".shard*"))
+        if os.path.exists(os.path.join(self.work_dir, port)):
+            paths.append(os.path.join(self.work_dir, port))
+        return sorted(paths)
+
+    def portMemory(self, port):
+        """
+        Estimated bytes held in memory when the port's records are grouped by key
+        """
+        return sum( SpillReader(path).rawSize() for path in self.portPaths(port) ) * HASH_EXPANSION
+
+    def portRecords(self, port, ordered=False, budget=None):
+        """
+        The (key, value) records of a port, in the order sortPort gives.
+        When the spill is estimated to fit in the memory budget (bytes,
+        default the whole --memory-budget), records are grouped by key in
+        memory and only each key's records are sorted, instead of sorting
+        the whole spill on disk.
+
+        With ordered, records are (key, JSON text, value), the text being
+        what records sharing a key are sorted by (spill_order).
+        """
+        if budget is None:
+            budget = self.config.memory_budget * 1048576
+        paths = self.portPaths(port)
+        size = self.portMemory(port)
+        if not len(paths) or size > budget:
+            print "%s: external sort (est. %.1f MB in memory)" % (port, size / 1048576.0)
+            self.sortPort(port)
+            return TableReader(os.path.join(self.work_dir, port + ".sort"), ordered)
+        print "%s: hash aggregation (est. %.1f MB in memory)" % (port, size / 1048576.0)
+        return self.hashPortRecords(paths, ordered)
+
+    def hashPortRecords(self, paths, ordered=False):
+        readers = [ SpillReader(path) for path in paths ]
+        schemas = set( reader.schema for reader in readers )
+        schema = None
+        if len(schemas) == 1:
+            schema = schemas.pop()
+        groups = {}
+        for reader in readers:
+            #payloads must compare the way they do in the sorted spill
+            convert = reader.schema != schema
+            for key, payload in reader.raw():
+                if convert:
+                    payload = spill_convert(reader.schema, payload)
+                if key in groups:
+                    groups[key].append(payload)
+                else:
+                    groups[key] = [payload]
+        for key in sorted(groups):
+            payloads = groups.pop(key)
+            if len(payloads) > 1:
+                payloads.sort(key=lambda payload: spill_order(schema, payload))
+            for payload in payloads:
+                if ordered:
+                    yield key, spill_order(schema, payload), decode_spill(schema, payload)
+                else:
+                    yield key, decode_spill(schema, payload)
+
+    def sortPort(self, port):
+        """
+        Sort the spill file of a port, together with any shards written by
+        scan workers, into <port>.sort. Records are ordered by key, ties by
+        their JSON text (spill_order), so the result doesn't depend on which worker
+        emitted them. Returns False if nothing was emitted to the port (the
+        .sort file is then empty).
+        """
+        paths = self.portPaths(port)
+        if not len(paths):
+            open(os.path.join(self.work_dir, port + ".sort"), "w").close()
+            return False
+        spill_dir = self.config.spill_dir
+        if spill_dir is None:
+            spill_dir = self.work_dir
+        sorter = ExternalSorter(self.config.memory_budget * 1048576, spill_dir, self.config.sort_workers, self.config.spill_codec)
+        sorter.sort(sorted(paths), os.path.join(self.work_dir, port + ".sort"))
+        return True
 
     def emitFile(self, dataSubType, meta, file):
         md5 = hashlib.md5()
         oHandle = open(self.config.getOutPath(self.dataSubTypes[dataSubType]['nameGen']), "wb")
-        with open(file,'rb') as f: 
+        with closing(self.openFile(file,'rb')) as f: 
             for chunk in iter(lambda: f.read(8192), ''): 
                 md5.update(chunk)
                 oHandle.write(chunk)
@@ -415,10 +2222,11 @@ idfMap = {
 }
 
 class TCGAGeneticImport(FileImporter):      
+    columnarScan = False
     
     def mageScan(self, path):
         if path.endswith(".sdrf.txt"):
-            iHandle = open(path, "rU")
+            iHandle = self.openFile(path, "rU")
             read = csv.reader( iHandle, delimiter="\t" )
             colNum = None
             for row in read:
@@ -445,7 +2253,7 @@ class TCGAGeneticImport(FileImporter):
                         except IndexError:
                             pass #there can be blank lines in the SDRF
         if path.endswith(".idf.txt"):
-            iHandle = open(path)
+            iHandle = self.openFile(path)
             for line in iHandle:
                 row = line.split("\t")
                 if len(row):
@@ -453,7 +2261,7 @@ class TCGAGeneticImport(FileImporter):
                         self.ext_meta[ idfMap[row[0]] ] = row[1]
             iHandle.close()
         if path.endswith("DESCRIPTION.txt"):
-            handle = open(path)
+            handle = self.openFile(path)
             self.description = handle.read()
             handle.close()
     
@@ -463,7 +2271,7 @@ class TCGAGeneticImport(FileImporter):
 
     @staticmethod
     def getArchiveQuery(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=Level_3]]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=Level_3]]" % (basename), baseName=basename, archive_type="Level_3")
         for e in q:
             yield e
     
@@ -475,13 +2283,13 @@ class TCGAGeneticImport(FileImporter):
 
     @staticmethod
     def getArchiveUrls(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=Level_3]]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=Level_3]]" % (basename), baseName=basename, archive_type="Level_3")
         for e in q:
             yield e['deployLocation']
 
     @staticmethod
     def getMageUrl(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename), baseName=basename, archive_type="mage-tab")
         out = None
         for e in q:
             out = e['deployLocation']
@@ -489,7 +2297,7 @@ class TCGAGeneticImport(FileImporter):
 
     @staticmethod
     def getArchiveList(platform):
-        q = CustomQuery("Archive[Platform[@name=%s]][@isLatest=1]" % platform)
+        q = archive_query("Archive[Platform[@name=%s]][@isLatest=1]" % platform, platform=platform)
         out = {}
         for e in q:
             name = e['baseName']
@@ -502,7 +2310,7 @@ class TCGAGeneticImport(FileImporter):
         return self.config.translateUUID(uuid)
     
     def getTargetMap(self):
-        subprocess.call("sort -k 1 %s/targets > %s/targets.sort" % (self.work_dir, self.work_dir), shell=True)                
+        self.sortPort("targets")
         handle = TableReader(self.work_dir + "/targets.sort")
         tTrans = {}
         for key, value in handle:
@@ -516,7 +2324,7 @@ class TCGAGeneticImport(FileImporter):
         it emits these values to a handle, using the 'targets' and 'probes' string to identify 
         the type of data being emited
         """
-        iHandle = open(path)
+        iHandle = self.openFile(path)
         mode = None
         #modes
         #1 - segmentFile - one sample per file/no sample info inside file
@@ -545,6 +2353,9 @@ class TCGAGeneticImport(FileImporter):
                 for i in range(len(colType)):
                     if commonMap.has_key( colType[i] ):
                         colType[i] = commonMap[ colType[i] ]
+                if self.columnarScan and self.config.columnar:
+                    if self.scanColumns(iHandle, dataSubType, colName, colType):
+                        break
             else:
                 tmp = line.rstrip().split("\t")
                 if mode == 2:
@@ -571,6 +2382,52 @@ class TCGAGeneticImport(FileImporter):
                     else:
                         self.emit( tmp[0], out,  dataSubType + ".probes" )
 
+    def scanColumns(self, iHandle, dataSubType, colName, colType):
+        """
+        Read the rows of a two header matrix file column wise. The
+        probeFields column each target gets its value from is picked once,
+        and every row is emitted to <dataSubType>.columns as a single
+        (file id, values) record, rather than as one record per target.
+        The [target, probeField] pairs of the file are emitted to
+        <dataSubType>.layout.
+
+        Returns False, having read no rows, when a target has columns of
+        more than one probeField: its records then hold several values,
+        and the file has to be read per record.
+        """
+        probeFields = self.dataSubTypes[dataSubType]['probeFields']
+        #same pick as the per record scan: of repeated columns the last one
+        pick = {}
+        for i in range(1, len(colType)):
+            if colType[i] in probeFields:
+                if colName[i] in pick and pick[colName[i]][0] != colType[i]:
+                    return False
+                pick[colName[i]] = (colType[i], i)
+        targets = sorted(pick, key=lambda t: pick[t][1])
+        cols = [ pick[t][1] for t in targets ]
+        if self.shard is None:
+            fileId = "%d" % (self.columnFiles)
+        else:
+            fileId = "%d.%d" % (self.shard, self.columnFiles)
+        self.columnFiles += 1
+        self.emit( fileId, [ [t, pick[t][0]] for t in targets ], dataSubType + ".layout" )
+        if len(colName) < 2:
+            return True
+        port = dataSubType + ".columns"
+        for line in iHandle:
+            tmp = line.rstrip().split("\t")
+            values = []
+            for i in cols:
+                try:
+                    values.append( self.columnValue(tmp[i]) )
+                except (IndexError, ValueError):
+                    values.append( "NA" )
+            self.emit( tmp[0], (fileId, tuple(values)), port )
+        return True
+
+    def columnValue(self, value):
+        return value
+
         
 def get_field_match(value, fields):
     for f in fields:
@@ -587,7 +2444,7 @@ class TCGASegmentImport(TCGAGeneticImport):
         it emits these values to a handle, using the 'targets' and 'probes' string to identify 
         the type of data being emited
         """
-        iHandle = open(path)
+        iHandle = self.openFile(path)
         mode = None
         #modes
         #1 - segmentFile - one sample per file/no sample info inside file
@@ -640,7 +2497,7 @@ class TCGASegmentImport(TCGAGeneticImport):
         #numbers
 
         tTrans = self.getTargetMap()        
-        subprocess.call("sort -k 1 %s/%s.segments > %s/%s.segments.sort" % (self.work_dir, dataSubType, self.work_dir, dataSubType), shell=True)
+        self.sortPort(dataSubType + ".segments")
         sHandle = TableReader(self.work_dir + "/%s.segments.sort" % (dataSubType))
 
         segFile = None
@@ -696,7 +2553,174 @@ def dict_merge(x, y):
             result[k] = v
     return result
 
+#bytes before the data of an .npy file, kept fixed so the shape can be rewritten
+NPY_HEADER = 128
+
+def npy_header(shape):
+    """
+    Version 1.0 .npy header for a little endian float32 C order array
+    """
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % shape
+    header = header.ljust(NPY_HEADER - 11) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+
+class NpyWriter:
+    """
+    float32 matrix in the .npy format, written a block of rows at a time.
+    The row count goes into the header on close.
+    """
+    def __init__(self, path, width):
+        self.handle = open(path, "wb")
+        self.width = width
+        self.rows = 0
+        self.handle.write(npy_header( (0, width) ))
+
+    def write(self, data, rows):
+        self.handle.write(data)
+        self.rows += rows
+
+    def close(self):
+        self.handle.seek(0)
+        self.handle.write(npy_header( (self.rows, self.width) ))
+        self.handle.close()
+
+
+class MatrixWriter:
+    """
+    Text probe x sample matrix. Rows are given as a dict of matrix column
+    to value, written exactly as read, and rows with nothing but NA are
+    dropped.
+
+    With binary, the written rows also go to <path>.npy as float32 (NaN
+    for NA or non numeric values), their probes to <path>.probes and the
+    sample labels to <path>.samples, one per line.
+    """
+    def __init__(self, path, labels, binary=False):
+        self.path = path
+        self.handle = open(path, "w")
+        self.width = len(labels)
+        self.rowCount = 0
+        self.handle.write( "%s\t%s\n" % ( "#probe", "\t".join( labels ) ) )
+        self.npy = None
+        if binary:
+            self.npy = NpyWriter(path + ".npy", self.width)
+            self.probeHandle = open(path + ".probes", "w")
+            handle = open(path + ".samples", "w")
+            for label in labels:
+                handle.write( "%s\n" % (label) )
+            handle.close()
+            self.nanRow = array.array("f", [float("nan")] * self.width)
+
+    def addRow(self, probe, cells):
+        out = ["NA"] * self.width
+        for column in cells:
+            out[ column ] = cells[ column ]
+        if out.count("NA") != self.width:
+            self.rowCount += 1
+            self.handle.write( "%s\t%s\n" % ( probe, "\t".join( out ) ) )
+            if self.npy is not None:
+                self.writeBinaryRow(probe, cells)
+
+    def writeBinaryRow(self, probe, cells):
+        values = array.array("f", self.nanRow)
+        for column in cells:
+            try:
+                values[column] = float(cells[column])
+            except ValueError:
+                pass
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.npy.write(values.tostring(), 1)
+        self.probeHandle.write( "%s\n" % (probe) )
+
+    def close(self):
+        self.handle.close()
+        if self.npy is not None:
+            self.npy.close()
+            self.probeHandle.close()
+
+
+#cells per float32 block, so wide cohorts hold fewer rows in memory
+MATRIX_BLOCK_CELLS = 1 << 18
+
+def float32_values(values):
+    """
+    Parse value strings into a float32 array, anything that isn't a
+    number becoming NaN
+    """
+    try:
+        return numpy.array(values, dtype=numpy.float32)
+    except ValueError:
+        out = numpy.empty(len(values), dtype=numpy.float32)
+        for i, value in enumerate(values):
+            try:
+                out[i] = float(value)
+            except ValueError:
+                out[i] = numpy.nan
+        return out
+
+
+class FloatMatrixWriter(MatrixWriter):
+    """
+    Matrix normalised to float32: every value is written in its shortest
+    float32 form, and anything that isn't a number becomes NA, so the
+    output doesn't always match the input text; rows with no numeric value
+    are dropped. Rows are gathered into numpy blocks, NaN where a sample
+    has no value, and each block is parsed, filtered and formatted at once.
+
+    This is an output format, not a faster path: formatting float32 back
+    to text costs more than writing the strings as read, so it is slower
+    than MatrixWriter.
+    """
+    def __init__(self, path, labels, binary=False):
+        MatrixWriter.__init__(self, path, labels, binary)
+        self.blockRows = max(1, MATRIX_BLOCK_CELLS / max(1, self.width))
+        self.probes = []
+        self.rows = []
+        self.columns = []
+        self.values = []
+
+    def addRow(self, probe, cells):
+        row = len(self.probes)
+        self.probes.append(probe)
+        #keys() and values() of an unchanged dict are in the same order
+        self.rows.extend( [row] * len(cells) )
+        self.columns.extend( cells.keys() )
+        self.values.extend( cells.values() )
+        if len(self.probes) >= self.blockRows:
+            self.writeBlock()
+
+    def writeBlock(self):
+        block = numpy.empty( (len(self.probes), self.width), dtype=numpy.float32 )
+        block.fill(numpy.nan)
+        if len(self.values):
+            block[self.rows, self.columns] = float32_values(self.values)
+        missing = numpy.isnan(block)
+        text = block.astype(str)
+        text[missing] = "NA"
+        write = self.handle.write
+        keep = numpy.flatnonzero(~missing.all(axis=1))
+        for i in keep:
+            write( "%s\t%s\n" % ( self.probes[i], "\t".join( text[i].tolist() ) ) )
+            self.rowCount += 1
+        if self.npy is not None:
+            self.npy.write(block[keep].astype("<f4").tostring(), len(keep))
+            for i in keep:
+                self.probeHandle.write( "%s\n" % (self.probes[i]) )
+        self.probes = []
+        self.rows = []
+        self.columns = []
+        self.values = []
+
+    def close(self):
+        if len(self.probes):
+            self.writeBlock()
+        MatrixWriter.close(self)
+
+
 class TCGAMatrixImport(TCGAGeneticImport):
+    columnarScan = True
     
     def getMeta(self, name, dataSubType):
         matrixInfo = { 
@@ -713,19 +2737,66 @@ class TCGAMatrixImport(TCGAGeneticImport):
         matrixInfo = dict_merge(matrixInfo, self.ext_meta)
         matrixInfo = dict_merge(matrixInfo, self.config.meta)
         return matrixInfo
+
+    def columnLayouts(self, dataSubType, tColumn):
+        """
+        For each file scanned by scanColumns: the (position, matrix column)
+        slots of its targets, the targets missing from the target map, and
+        for every target (position, target, prefix, suffix), where prefix +
+        JSON value + suffix is the JSON text of the record --no-columnar
+        spills for it.
+
+        Also returns whether rows have to be replayed as those records:
+        when two targets share a matrix column (replicate hybridizations,
+        aliquots mapped to one barcode), or a target is read from different
+        probeFields, the slots alone can't tell which value wins.
+        """
+        layouts = {}
+        columnTarget = {}
+        targetField = {}
+        replay = False
+        for path in self.portPaths(dataSubType + ".layout"):
+            for fileId, fields in SpillReader(path):
+                slots = []
+                missing = []
+                records = []
+                for pos, (target, field) in enumerate(fields):
+                    record = { "target" : target }
+                    record[field] = u"\0"
+                    prefix, suffix = json.dumps(record).split('"\\u0000"')
+                    records.append( (pos, target, prefix, suffix) )
+                    if targetField.setdefault(target, field) != field:
+                        replay = True
+                    if target not in tColumn:
+                        missing.append(target)
+                    elif tColumn[target] is not None:
+                        slots.append( (pos, tColumn[target]) )
+                        if columnTarget.setdefault(tColumn[target], target) != target:
+                            replay = True
+                layouts[fileId] = (slots, missing, records)
+        return layouts, replay
+
+    def recordCell(self, dataSubType, value):
+        """
+        The (target, value) a per target probe record sets, or None
+        """
+        if "target" in value:
+            target = value[ "target" ]
+        elif "file" in value:
+            target = value[ "file" ]
+        else:
+            return None
+        cell = None
+        for probeField in self.dataSubTypes[dataSubType]['probeFields']:
+            if probeField in value:
+                cell = (target, value[ probeField ])
+        return cell
         
     def fileBuild(self, dataSubType):
         #use the target table to create a name translation table
         #also setup target name enumeration, so they will have columns
         #numbers        
         
-        subprocess.call("sort -k 1 %s/%s.probes > %s/%s.probes.sort" % (self.work_dir, dataSubType, self.work_dir, dataSubType), shell=True)
-        subprocess.call("sort -k 1 %s/targets > %s/targets.sort" % (self.work_dir, self.work_dir), shell=True)
-                
-        handles = {}
-        handles[ "geneticExtract:targets" ] = TableReader(self.work_dir + "/targets.sort")
-        handles[ "geneticExtract:%s.probes" % (dataSubType) ] = TableReader(self.work_dir + "/%s.probes.sort" % (dataSubType))
-
         tTrans = self.getTargetMap()
         
         tEnum = {}
@@ -733,50 +2804,123 @@ class TCGAMatrixImport(TCGAGeneticImport):
             tlabel = self.translateUUID(tTrans[t])
             if tlabel is not None and tlabel not in tEnum:
                 tEnum[tlabel] = len(tEnum)
+        #matrix column of each target, resolved once rather than per value
+        tColumn = {}
+        for t in tTrans:
+            tColumn[t] = tEnum.get(self.translateUUID(tTrans[t]))
                 
         matrixFile = None
         segFile = None
 
         curName = None
         curData = {}
+        #values of columnar rows, by matrix column
+        curCells = {}
+        curMissing = set()
+        #(JSON text, target, value) of columnar values, and the per target
+        #records of the probe, when the row has to be replayed
+        curReplay = []
+        curRecords = []
         missingCount = 0
-        rowCount = 0
-        pHandle = handles["geneticExtract:%s.probes" % (dataSubType)]
-        for key, value in pHandle:
+        layouts, replay = self.columnLayouts(dataSubType, tColumn)
+        if len(layouts):
+            #columnar rows are (file id, values) tuples, merged in by probe,
+            #and per target records come with their JSON text to replay by.
+            #Both ports are read at once, so they share the memory budget:
+            #the columns get it first, the per target records what is left
+            budget = self.config.memory_budget * 1048576
+            columnSize = self.portMemory(dataSubType + ".columns")
+            if columnSize <= budget:
+                budget -= columnSize
+            pHandle = heapq.merge(self.portRecords(dataSubType + ".probes", True, budget), self.portRecords(dataSubType + ".columns"))
+        else:
+            pHandle = self.portRecords(dataSubType + ".probes")
+        for record in pHandle:
+            key, value = record[0], record[-1]
             if matrixFile is None:
-                matrixFile = open("%s/%s.matrix_file" % (self.work_dir, dataSubType), "w" )            
                 out = ["NA"] * len(tEnum)
                 for target in tEnum:
                     out[ tEnum[ target ] ] = target
-                matrixFile.write( "%s\t%s\n" % ( "#probe", "\t".join( out ) ) )        
+                if self.config.float32_matrix:
+                    matrixFile = FloatMatrixWriter("%s/%s.matrix_file" % (self.work_dir, dataSubType), out, self.config.binary_matrix)
+                else:
+                    matrixFile = MatrixWriter("%s/%s.matrix_file" % (self.work_dir, dataSubType), out, self.config.binary_matrix)
             
             if curName != key:
                 if curName is not None:
-                    out = ["NA"] * len(tEnum)
+                    if len(curReplay):
+                        #set curData in the order the records would have
+                        #been sorted in, as a --no-columnar build does
+                        for text, data in curRecords:
+                            cell = self.recordCell(dataSubType, data)
+                            if cell is not None:
+                                curReplay.append( (text,) + cell )
+                        curReplay.sort()
+                        curData = {}
+                        for text, target, v in curReplay:
+                            curData[ target ] = v
+                    cells = {}
                     for target in curData:
-                        try:
-                            ttarget = self.translateUUID(tTrans[target])
-                            if ttarget is not None:
-                                out[ tEnum[ ttarget ] ] = str( curData[ target ] )
-                        except KeyError:
+                        if target not in tColumn:
                             self.addError( "TargetInfo Not Found: %s" % (target))
-                    if out.count("NA") != len(tEnum):
-                        rowCount += 1
-                        matrixFile.write( "%s\t%s\n" % ( curName, "\t".join( out ) ) )  
+                        elif tColumn[target] is not None:
+                            cells[ tColumn[target] ] = str( curData[ target ] )
+                    cells.update(curCells)
+                    for target in curMissing:
+                        self.addError( "TargetInfo Not Found: %s" % (target))
+                    matrixFile.addRow(curName, cells)
                 curName = key
                 curData = {}
-            if "target" in value:
-                for probeField in self.dataSubTypes[dataSubType]['probeFields']:
-                    if probeField in value:
-                        curData[ value[ "target" ] ] = value[ probeField ]
-            elif "file" in value:
-                for probeField in self.dataSubTypes[dataSubType]['probeFields']:
-                    if probeField in value:
-                        curData[ value[ "file" ] ] = value[ probeField ]
+                curCells = {}
+                curMissing = set()
+                curReplay = []
+                curRecords = []
+            if isinstance(value, tuple):
+                slots, missing, records = layouts[ value[0] ]
+                values = value[1]
+                #per target records of a probe, (key, text, dict), sort
+                #before its columnar rows, (key, tuple)
+                if replay or len(curRecords):
+                    for pos, target, prefix, suffix in records:
+                        curReplay.append( (prefix + encode_basestring_ascii(values[pos]) + suffix, target, values[pos]) )
+                else:
+                    #each column has one target, which gets the value whose
+                    #JSON text sorts last, as it would as separate records
+                    for pos, column in slots:
+                        if column not in curCells or encode_basestring_ascii(values[pos]) > encode_basestring_ascii(curCells[column]):
+                            curCells[ column ] = values[pos]
+                    if len(missing):
+                        curMissing.update(missing)
+            else:
+                cell = self.recordCell(dataSubType, value)
+                if cell is not None:
+                    curData[ cell[0] ] = cell[1]
+                if len(layouts):
+                    curRecords.append( (record[1], value) )
         matrixFile.close()
+        rowCount = matrixFile.rowCount
         matrixName = self.config.name    
         if rowCount > 0:
-            self.emitFile( dataSubType, self.getMeta(matrixName, dataSubType), "%s/%s.matrix_file"  % (self.work_dir, dataSubType) )
+            meta = self.getMeta(matrixName, dataSubType)
+            if matrixFile.npy is not None:
+                meta['binaryMatrix'] = self.emitBinary(dataSubType, matrixFile)
+            self.emitFile( dataSubType, meta, "%s/%s.matrix_file"  % (self.work_dir, dataSubType) )
+
+    def emitBinary(self, dataSubType, matrixFile):
+        """
+        Move the binary matrix and its probe and sample lists next to the
+        output matrix, returning their description for the metadata
+        """
+        outPath = self.config.getOutPath(self.dataSubTypes[dataSubType]['nameGen'])
+        info = {
+            'format' : 'npy',
+            'dtype' : 'float32',
+            'shape' : [ matrixFile.rowCount, matrixFile.width ]
+        }
+        for key, ext in [ ('data', '.npy'), ('rowKeys', '.probes'), ('columnKeys', '.samples') ]:
+            shutil.move(matrixFile.path + ext, outPath + ext)
+            info[key] = { 'name' : os.path.basename(outPath + ext), 'md5' : fileDigest(outPath + ext) }
+        return info
 
 
 adminNS = "http://tcga.nci/bcr/xml/administration/2.3"
@@ -806,12 +2950,16 @@ def dom_scan_iter(node, stack, prefix):
 class TCGAClinicalImport(FileImporter):
     
     def fileScan(self, path, dataSubType):
-        print "Parsing", dataSubType, path
-        handle = open(path)
+        self.fileScanMulti(path, [dataSubType])
+
+    def fileScanMulti(self, path, dataSubTypes):
+        print "Parsing", ",".join(dataSubTypes), path
+        handle = self.openFile(path)
         data = handle.read()
         handle.close()
         xml=parseString(data)
-        self.parseXMLFile(xml, dataSubType)
+        for dataSubType in dataSubTypes:
+            self.parseXMLFile(xml, dataSubType)
             
     def getText(self, nodelist):
         rc = []
@@ -826,20 +2974,20 @@ class TCGAClinicalImport(FileImporter):
 
     @staticmethod
     def getArchiveQuery(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1]" % (basename), baseName=basename)
         for e in q:
             yield e
 
 
     @staticmethod
     def getArchiveUrls(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][platform[@alias=bio]]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][platform[@alias=bio]]" % (basename), baseName=basename, platform_alias="bio")
         for e in q:
             yield e['deployLocation']
 
     @staticmethod
     def getMageUrl(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (basename), baseName=basename, archive_type="mage-tab")
         out = None
         for e in q:
             out = e['deployLocation']
@@ -981,8 +3129,7 @@ class TCGAClinicalImport(FileImporter):
     
     def fileBuild(self, dataSubType):
 
-        if os.path.exists( "%s/%s" % (self.work_dir, dataSubType)):
-            subprocess.call("cat %s/%s | sort -k 1 > %s/%s.sort" % (self.work_dir, dataSubType, self.work_dir, dataSubType), shell=True)
+        if self.sortPort(dataSubType):
             handle = TableReader(self.work_dir + "/" + dataSubType + ".sort")
             matrix = {}
             colEnum = {}
@@ -1072,7 +3219,11 @@ class SNP6Import(TCGASegmentImport):
     }
     
     def fileScan(self, path, dataSubType):
-        handle = open(path)
+        self.fileScanMulti(path, [dataSubType])
+
+    def fileScanMulti(self, path, dataSubTypes):
+        #the segment and probe count subtypes read the same files, parse them once
+        handle = self.openFile(path)
         colName = None
         for line in handle:
             if colName is None:
@@ -1085,13 +3236,14 @@ class SNP6Import(TCGASegmentImport):
                 out = {}
                 for i in range(1, len(colName)):
                     out[ colName[i] ] = tmp[i]
-                self.emit( tmp[0], out, dataSubType )
+                for dataSubType in dataSubTypes:
+                    self.emit( tmp[0], out, dataSubType )
         handle.close()
     
     def fileBuild(self, dataSubType):
         tmap = self.getTargetMap()  
         
-        subprocess.call("sort -k 1 %s/%s > %s/%s.sort" % (self.work_dir, dataSubType, self.work_dir, dataSubType), shell=True)                
+        self.sortPort(dataSubType)
         handle = TableReader(self.work_dir + "/%s.sort" % (dataSubType))
 
         segFile = None
@@ -1269,7 +3421,7 @@ class HumanMethylation450(TCGAMatrixImport):
         it emits these values to a handle, using the 'targets' and 'probes' string to identify 
         the type of data being emited
         """
-        iHandle = open(path)
+        iHandle = self.openFile(path)
         mode = None
         #modes
         #1 - two col header matrix file
@@ -1289,6 +3441,9 @@ class HumanMethylation450(TCGAMatrixImport):
                 for i in range(len(colType)):
                     if commonMap.has_key( colType[i] ):
                         colType[i] = commonMap[ colType[i] ]
+                if self.columnarScan and self.config.columnar:
+                    if self.scanColumns(iHandle, dataSubType, colName, colType):
+                        break
             else:
                 tmp = line.rstrip().split("\t")
                 if mode == 1:
@@ -1305,6 +3460,9 @@ class HumanMethylation450(TCGAMatrixImport):
                             out[ colName[i] ][ colType[i] ] = "NA"
                     for col in out:
                         self.emit( tmp[0], out[col], dataSubType + ".probes" )
+
+    def columnValue(self, value):
+        return "%.4f" % float(value)
                 
 class Illumina_RNASeq(TCGAMatrixImport):
     dataSubTypes = {
@@ -1363,7 +3521,7 @@ class MDA_RPPA_Core(TCGAMatrixImport):
     }
 
     def getTargetMap(self):
-        subprocess.call("sort -k 1 %s/targets > %s/targets.sort" % (self.work_dir, self.work_dir), shell=True)                
+        self.sortPort("targets")
         handle = TableReader(self.work_dir + "/targets.sort")
         tTrans = {}
         for key, value in handle:
@@ -1437,6 +3595,8 @@ class bioImport(TCGAClinicalImport):
     }
 
 class MafImport(FileImporter):
+    #fileScan writes the output file itself, so files must be scanned in order
+    parallelScan = False
     dataSubTypes = {
         'maf' : {
             'fileInclude' : '.*.maf$',
@@ -1463,7 +3623,7 @@ class MafImport(FileImporter):
 
     def mageScan(self, path):
         if path.endswith(".idf.txt"):
-            iHandle = open(path)
+            iHandle = self.openFile(path)
             for line in iHandle:
                 row = line.split("\t")
                 if len(row):
@@ -1471,7 +3631,7 @@ class MafImport(FileImporter):
                         self.ext_meta[ idfMap[row[0]] ] = row[1]
             iHandle.close()
         if path.endswith("DESCRIPTION.txt"):
-            handle = open(path)
+            handle = self.openFile(path)
             self.description = handle.read()
             handle.close()
 
@@ -1481,7 +3641,7 @@ class MafImport(FileImporter):
 
     @staticmethod
     def getArchiveQuery(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1]" % (basename), baseName=basename)
         for e in q:
             u = e['deployLocation']
             if u.count("anonymous"):
@@ -1489,7 +3649,7 @@ class MafImport(FileImporter):
     
     @staticmethod
     def getArchiveQuery(basename):
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1]" % (basename))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1]" % (basename), baseName=basename)
         for e in q:
             u = e['deployLocation']
             if u.count("anonymous"):
@@ -1498,7 +3658,7 @@ class MafImport(FileImporter):
 
     @staticmethod
     def getArchiveUrls(basename):
-        q = CustomQuery("Archive[@isLatest=1][@baseName=%s]" % (basename))
+        q = archive_query("Archive[@isLatest=1][@baseName=%s]" % (basename), baseName=basename)
         for e in q:
             u = e['deployLocation']
             if u.count("anonymous"):
@@ -1506,7 +3666,7 @@ class MafImport(FileImporter):
 
     @staticmethod
     def getMageUrl(basename):
-        q = CustomQuery("Archive[@isLatest=1][@baseName=%s][ArchiveType[@type=mage-tab]]" % (basename))
+        q = archive_query("Archive[@isLatest=1][@baseName=%s][ArchiveType[@type=mage-tab]]" % (basename), baseName=basename, archive_type="mage-tab")
         out = None
         for e in q:
             u = e['deployLocation']
@@ -1516,7 +3676,7 @@ class MafImport(FileImporter):
 
     @staticmethod
     def getArchiveList(platform):
-        q = CustomQuery("Archive[Platform[@name=%s]][@isLatest=1]" % platform)
+        q = archive_query("Archive[Platform[@name=%s]][@isLatest=1]" % platform, platform=platform)
         out = {}
         for e in q:
             if  e['deployLocation'].count("anonymous"):
@@ -1572,10 +3732,97 @@ tcgaConfig = {
 def fileDigest( file ):
     md5 = hashlib.md5()
     with open(file,'rb') as f: 
-        for chunk in iter(lambda: f.read(8192), ''): 
+        for chunk in iter(lambda: f.read(1048576), ''): 
             md5.update(chunk)
     return md5.hexdigest()
 
+def fileStamp( file ):
+    st = os.stat(file)
+    return { 'size' : st.st_size, 'mtime' : st.st_mtime, 'inode' : st.st_ino }
+
+def recordVerified( file, md5 ):
+    """
+    Write the '.verified' sidecar, noting the file stat the md5 was checked against
+    """
+    stamp = fileStamp(file)
+    stamp['md5'] = md5
+    handle = open(file + ".verified.tmp", "w")
+    handle.write(json.dumps(stamp))
+    handle.close()
+    os.rename(file + ".verified.tmp", file + ".verified")
+
+def checkArchive( file ):
+    """
+    Compare an archive with its .md5. The file is only rehashed if its size,
+    mtime or inode changed since the last successful check.
+    """
+    handle = open( file + ".md5" )
+    omd5 = handle.readline().split(' ')[0]
+    handle.close()
+    if os.path.exists(file + ".verified"):
+        try:
+            handle = open(file + ".verified")
+            ledger = json.loads(handle.read())
+            handle.close()
+            stamp = fileStamp(file)
+            stamp['md5'] = omd5
+            if ledger == stamp:
+                return True
+        except ValueError:
+            pass #damaged sidecar, rehash
+    if fileDigest(file) != omd5:
+        return False
+    recordVerified(file, omd5)
+    return True
+
+def archiveDigest( file ):
+    """
+    md5 of an archive, taken from its .verified sidecar when the file is
+    unchanged since it was last checked
+    """
+    if os.path.exists(file + ".verified"):
+        try:
+            handle = open(file + ".verified")
+            ledger = json.loads(handle.read())
+            handle.close()
+            md5 = ledger.pop('md5', None)
+            if ledger == fileStamp(file):
+                return md5
+        except ValueError:
+            pass
+    return fileDigest(file)
+
+def parallel_map( func, items, workers ):
+    """
+    map func over items with a pool of threads, results in item order
+    """
+    out = [None] * len(items)
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put( (i, item) )
+    errors = []
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                out[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+    threads = []
+    for i in range(max(1, min(workers, len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    if len(errors):
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return out
+
 
 def platform_list():
     #q = CustomQuery("Platform")
@@ -1592,7 +3839,7 @@ def supported_list():
 
 def archive_list(platform=None):
     if platform is None:
-        q = CustomQuery("Archive[@isLatest=1][ArchiveType[@type=Level_3]]")
+        q = archive_query("Archive[@isLatest=1][ArchiveType[@type=Level_3]]", archive_type="Level_3")
         out = {}
         for e in q:
             name = e['baseName']
@@ -1600,7 +3847,7 @@ def archive_list(platform=None):
                 out[name] = True
         return out.keys()
     else:
-        q = CustomQuery("Archive[@isLatest=1][ArchiveType[@type=Level_3]][Platform[@alias=%s]]" % (platform))
+        q = archive_query("Archive[@isLatest=1][ArchiveType[@type=Level_3]][Platform[@alias=%s]]" % (platform), archive_type="Level_3", platform_alias=platform)
         out = {}
         for e in q:
             name = e['baseName']
@@ -1609,6 +3856,55 @@ def archive_list(platform=None):
         return out.keys()
 
 
+def setup_network(options):
+    global catalog
+    if options.offline and options.cache_dir is None:
+        sys.stderr.write("--offline requires --cache-dir\n")
+        sys.exit(1)
+    if options.cache_dir is not None:
+        dccwsItem.cache = ResponseCache(options.cache_dir, ttl=options.cache_ttl, offline=options.offline)
+        link_resolver.cache = ResponseCache(os.path.join(options.cache_dir, "links"), offline=options.offline, suffix=".json")
+    if options.dcc_url is not None:
+        dccwsItem.baseURL = options.dcc_url.rstrip("/") + "/tcgadccws/GetXML?query="
+        dccwsItem.dataURL = options.dcc_url.rstrip("/")
+    dccwsItem.prefetch = options.prefetch
+    http_session.pool_size = options.pool_size
+    dccwsItem.governor = RequestGovernor(rate=options.max_rate, burst=options.rate_burst, lock_path=options.rate_lock, max_retries=options.max_retries)
+    if options.catalog is not None and options.func != main_catalog:
+        if not os.path.exists(options.catalog):
+            sys.stderr.write("Catalog %s not found, run 'catalog sync' first\n" % (options.catalog))
+            sys.exit(1)
+        catalog = ArchiveCatalog(options.catalog)
+        link_resolver.cache = catalog
+
+
+def network_parser():
+    """
+    Parent parser with the network options, for the subcommands that query the DCC
+    """
+    parser_net = ArgumentParser(add_help=False)
+    parser_net.add_argument("--dcc-url", dest="dcc_url", help="DCC server location, eg a dccwsFixture.py stand-in", default=None)
+    parser_net.add_argument("--cache-dir", dest="cache_dir", help="Cache DCC query responses in directory", default=None)
+    parser_net.add_argument("--cache-ttl", dest="cache_ttl", type=int, help="Seconds before a cached response is refetched", default=None)
+    parser_net.add_argument("--offline", dest="offline", action="store_true", help="Only answer queries from the response cache", default=False)
+    parser_net.add_argument("--prefetch", dest="prefetch", type=int, help="Query result pages to fetch ahead (0 to disable)", default=2)
+    parser_net.add_argument("--pool-size", dest="pool_size", type=int, help="Idle keep-alive connections kept per host", default=4)
+    parser_net.add_argument("--max-rate", dest="max_rate", type=float, help="Max DCC queries per second", default=None)
+    parser_net.add_argument("--rate-burst", dest="rate_burst", type=int, help="Queries allowed back to back before --max-rate applies", default=1)
+    parser_net.add_argument("--rate-lock", dest="rate_lock", help="Lock file to share --max-rate between local processes", default=None)
+    parser_net.add_argument("--max-retries", dest="max_retries", type=int, help="Retries for transient DCC query errors", default=5)
+    parser_net.add_argument("--catalog", dest="catalog", help="Answer archive lookups from local catalog (see 'catalog sync')", default=None)
+    parser_net.add_argument("--net-stats", dest="net_stats", action="store_true", help="Print network statistics to stderr on exit", default=False)
+    return parser_net
+
+
+def print_net_stats(handle):
+    stats = http_session.stats
+    handle.write("http requests: %d new connections: %d reused connections: %d\n" % (stats['requests'], stats['new'], stats['reused']))
+    for host, stats in sorted(dccwsItem.governor.stats.items()):
+        handle.write("%s queries: %d retries: %d failures: %d throttle waits: %d (%.1fs)\n" % (host, stats['requests'], stats['retries'], stats['failures'], stats['throttle_waits'], stats['throttle_seconds']))
+
+
 def main_list(options):
     #################
     #list operations
@@ -1633,7 +3929,7 @@ def main_list(options):
             print c
 
     if options.list_type == "clinical":
-        q = CustomQuery("Archive[@isLatest=1][Platform[@alias=bio]]")
+        q = archive_query("Archive[@isLatest=1][Platform[@alias=bio]]", platform_alias="bio")
         out = {}
         for e in q:
             name = e['baseName']
@@ -1642,7 +3938,7 @@ def main_list(options):
                 out[name] = True
 
     if options.list_type == "mutation":
-        q = CustomQuery("Archive[@isLatest=1][Platform[@alias=Mutation Calling]]")
+        q = archive_query("Archive[@isLatest=1][Platform[@alias=Mutation Calling]]", platform_alias="Mutation Calling")
         out = {}
         for e in q:
             if e['deployLocation'].count("anonymous"):
@@ -1660,12 +3956,16 @@ def main_list(options):
 
     if options.list_type == "cancer":
         if options.name is None:
-            q = CustomQuery("Disease")
-            for e in q:
-                print e['abbreviation']
+            if catalog is not None:
+                for e in catalog.diseases():
+                    print e
+            else:
+                q = CustomQuery("Disease")
+                for e in q:
+                    print e['abbreviation']
 
         else:
-            q = CustomQuery("Archive[@isLatest=1][Disease[@abbreviation=%s]][ArchiveType[@type=Level_3]]" % (options.name))
+            q = archive_query("Archive[@isLatest=1][Disease[@abbreviation=%s]][ArchiveType[@type=Level_3]]" % (options.name), disease=options.name, archive_type="Level_3")
             out = {}
             for e in q:
                 name = e['baseName']
@@ -1675,15 +3975,31 @@ def main_list(options):
 
 
     if options.list_type == "filelist":
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=Level_%s]]" % (options.filelist, options.level))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=Level_%s]]" % (options.filelist, options.level), baseName=options.filelist, archive_type="Level_%s" % (options.level))
         for e in q:
             print e['deployLocation']
-        q = CustomQuery("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (options.filelist))
+        q = archive_query("Archive[@baseName=%s][@isLatest=1][ArchiveType[@type=mage-tab]]" % (options.filelist), baseName=options.filelist, archive_type="mage-tab")
         for e in q:
             print e['deployLocation']    
     return 0
 
 
+def main_catalog(options):
+    if options.catalog is None:
+        sys.stderr.write("Need catalog location (--catalog)\n")
+        return 1
+    cat = ArchiveCatalog(options.catalog)
+    if options.catalog_action == "sync":
+        link_resolver.cache = cat
+        start = time.time()
+        count = cat.sync()
+        print "synced %d archives in %.1f seconds" % (count, time.time() - start)
+    if options.catalog_action == "info":
+        for k, v in sorted(cat.info().items()):
+            print "%s\t%s" % (k, v)
+    return 0
+
+
 def main_download(options):
 
     ##################
@@ -1691,24 +4007,24 @@ def main_download(options):
     ##################
 
     if options.download_type == 'uuid':
-        url="https://tcga-data.nci.nih.gov/uuid/uuidBrowserExport.htm"
+        url=dccwsItem.dataURL + "/uuid/uuidBrowserExport.htm"
         data = {}
         data['exportType'] = 'tab'
         data['cols'] = "uuid,barcode"
         if options.output is not None:
-            urllib.urlretrieve( url, options.output, data=urllib.urlencode(data))
+            http_session.urlretrieve( url, options.output, data=urllib.urlencode(data))
         else:
-            print urllib.urlopen(url, data=urllib.urlencode(data)).read()
+            print http_session.urlopen(url, data=urllib.urlencode(data)).read()
 
     if options.download_type == 'samples':
-        url="https://tcga-data.nci.nih.gov/datareports/aliquotExport.htm"
+        url=dccwsItem.dataURL + "/datareports/aliquotExport.htm"
         data = {}
     
         data['exportType'] = 'tab'
         data['cols'] = 'aliquotId,disease,bcrBatch,center,platform,levelOne,levelTwo,levelThree'
         data['filterReq'] = json.dumps({"disease":"","levelOne":"","aliquotId":"","center":"","levelTwo":"","bcrBatch":"","platform":"","levelThree":""})
         data['formFilter'] = json.dumps({"disease":"","levelOne":"","aliquotId":"","center":"","levelTwo":"","bcrBatch":"","platform":"","levelThree":""})
-        handle = urllib.urlopen( url + "?" + urllib.urlencode(data))
+        handle = http_session.urlopen( url + "?" + urllib.urlencode(data))
     
         for line in handle:
             tmp = line.rstrip().split("\t")
@@ -1719,13 +4035,13 @@ def main_download(options):
                     print "\t".join( [ tmp[0], tmp[1], "Normal", tmp[4] ] )
 
     if options.download_type == 'barcode_dag':
-        url="https://tcga-data.nci.nih.gov/datareports/aliquotExport.htm"
+        url=dccwsItem.dataURL + "/datareports/aliquotExport.htm"
         data = {}        
         data['exportType'] = 'tab'
         data['cols'] = 'aliquotId'
         data['filterReq'] = json.dumps({"disease":"","levelOne":"","aliquotId":"","center":"","levelTwo":"","bcrBatch":"","platform":"","levelThree":""})
         data['formFilter'] = json.dumps({"disease":options.barcode_dag,"levelOne":"","aliquotId":"","center":"","levelTwo":"","bcrBatch":"","platform":"","levelThree":""})
-        handle = urllib.urlopen( url + "?" + urllib.urlencode(data))
+        handle = http_session.urlopen( url + "?" + urllib.urlencode(data))
 
         for line in handle:
             if line.startswith("TCGA"):
@@ -1740,11 +4056,11 @@ def main_download(options):
 
 
 def get_basename_platform(basename):
-    q = CustomQuery("Archive[@isLatest=1][baseName=%s]" % (basename))
+    q = archive_query("Archive[@isLatest=1][baseName=%s]" % (basename), baseName=basename)
     platform_url = None
     for e in q:
         platform_url = e['platform']
-    q = CustomQuery(platform_url)
+    q = link_resolver.resolve(platform_url)
     for e in q:
         basename_platform_alias = e['alias']
     return basename_platform_alias
@@ -1772,6 +4088,7 @@ def main_build(options):
             if mage_url:
                 urls.append(mage_url)
             
+            checks = []
             for url in urls:
                 dst = os.path.join(options.mirror, re.sub("^/", "", url))
                 if not os.path.exists( dst ):
@@ -1780,18 +4097,16 @@ def main_build(options):
                 if not os.path.exists( dst + ".md5" ):
                     print "MD5_NOT_FOUND", dst
                     continue
+                checks.append(dst)
 
-                handle = open( dst + ".md5" )
-                line = handle.readline()
-                omd5 = line.split(' ')[0]
-                handle.close()
-
-                nmd5 = fileDigest( dst )
-                if omd5 != nmd5:
+            for dst, ok in zip(checks, parallel_map(checkArchive, checks, options.checksum_workers)):
+                if not ok:
                     print "CORRUPT:", dst
                     if options.checksum_delete:
                         os.unlink(dst)
                         os.unlink(dst + ".md5")
+                        if os.path.exists(dst + ".verified"):
+                            os.unlink(dst + ".verified")
                 else:
                     print "OK:", dst        
 
@@ -1823,8 +4138,10 @@ if __name__ == "__main__":
 
     subparsers = parser.add_subparsers(title="subcommand")
 
+    #network options, shared by every subcommand
+    parser_net = network_parser()
 
-    parser_list = subparsers.add_parser('list')
+    parser_list = subparsers.add_parser('list', parents=[parser_net])
     parser_list.add_argument("list_type", choices=[
         "platforms",
         "archives",
@@ -1853,7 +4170,7 @@ if __name__ == "__main__":
 
     #other importer options
 
-    parser_download = subparsers.add_parser('download')
+    parser_download = subparsers.add_parser('download', parents=[parser_net])
     parser_download.add_argument("download_type", choices=[
         "uuid",
         "samples",
@@ -1869,8 +4186,15 @@ if __name__ == "__main__":
     """
     parser_download.set_defaults(func=main_download)
 
+    parser_catalog = subparsers.add_parser('catalog', parents=[parser_net])
+    parser_catalog.add_argument("catalog_action", choices=[
+        "sync",
+        "info"
+    ])
+    parser_catalog.set_defaults(func=main_catalog)
+
     #archive importers
-    parser_build = subparsers.add_parser('build')
+    parser_build = subparsers.add_parser('build', parents=[parser_net])
 
     parser_build.add_argument("basename", help="Convert TCGA project basename into cgData", default=None)
     parser_build.add_argument("--clinical-type", dest="clinical_type", help="Clinical Data Type", default=None)
@@ -1881,10 +4205,25 @@ if __name__ == "__main__":
     parser_build.add_argument("-m", "--mirror", dest="mirror", help="Mirror Location", default=None)
     parser_build.add_argument("-w", "--workdir", dest="workdir_base", help="Working directory", default="/tmp")
     parser_build.add_argument("-d", "--download", dest="download", help="Download files for archive", action="store_true", default=False)
+    parser_build.add_argument("--download-workers", dest="download_workers", type=int, help="Concurrent archive downloads", default=4)
+    parser_build.add_argument("--stream", dest="stream", help="Download, verify and extract missing archives in a single pass", action="store_true", default=False)
+    parser_build.add_argument("--no-extract", dest="no_extract", help="Scan archive members in place, without extracting to the work directory", action="store_true", default=False)
+    parser_build.add_argument("--extract-workers", dest="extract_workers", type=int, help="Archives decompressed in parallel", default=4)
+    parser_build.add_argument("--scan-workers", dest="scan_workers", type=int, help="Processes parsing archive files in parallel", default=4)
+    parser_build.add_argument("--memory-budget", dest="memory_budget", type=int, help="MB of spill records held in memory while sorting, or grouping matrix probes", default=512)
+    parser_build.add_argument("--spill-dir", dest="spill_dir", help="Directory for sort runs (default: the work directory)", default=None)
+    parser_build.add_argument("--spill-codec", dest="spill_codec", choices=["none", "zlib", "lz4"], help="Block compression for spill and sort files", default="none")
+    parser_build.add_argument("--no-columnar", dest="columnar", help="Emit each cell of two header matrix files as its own record, instead of one record per row", action="store_false", default=True)
+    parser_build.add_argument("--float32-matrix", dest="float32_matrix", help="Normalise matrix values to float32 (needs numpy): write each value in its shortest float32 form, and non numeric values as NA. Slower than the default, which keeps input values exactly", action="store_true", default=False)
+    parser_build.add_argument("--binary-matrix", dest="binary_matrix", help="Also write matrices as float32 .npy files, with .probes and .samples row and column lists", action="store_true", default=False)
+    parser_build.add_argument("--sort-workers", dest="sort_workers", type=int, help="Processes generating sort runs in parallel", default=4)
+    parser_build.add_argument("--extract-cache", dest="extract_cache", help="Keep extracted archives in this directory, keyed by md5, for reuse by later builds", default=None)
+    parser_build.add_argument("--extract-cache-size", dest="extract_cache_size", type=int, help="Extract cache size limit in MB (least recently used entries are evicted)", default=None)
     parser_build.add_argument("--download-only", dest="download_only", help="Download files for archive then quit", action="store_true", default=False)
     parser_build.add_argument("-e", "--level", dest="level", help="Data Level ", default="3")
     parser_build.add_argument("--checksum", dest="checksum", help="Check project md5", action="store_true", default=False)
     parser_build.add_argument("--checksum-delete", dest="checksum_delete", help="Check project md5 and delete bad files", action="store_true", default=False)
+    parser_build.add_argument("--checksum-workers", dest="checksum_workers", type=int, help="Archives hashed in parallel by --checksum", default=4)
     parser_build.add_argument("-r", "--sanitize", dest="sanitize", action="store_true", help="Remove race/ethnicity from clinical data", default=False) 
 
     #output
@@ -1897,4 +4236,8 @@ if __name__ == "__main__":
 
 
     args = parser.parse_args()
-    sys.exit(args.func(args))
+    setup_network(args)
+    ret = args.func(args)
+    if args.net_stats:
+        print_net_stats(sys.stderr)
+    sys.exit(ret)
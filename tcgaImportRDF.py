@@ -8,83 +8,20 @@ from urlparse import urlparse
 from rdflib import Namespace, BNode, Graph, Literal, URIRef
 from rdflib.namespace import RDF
 
+from tcgaImport import CustomQuery, dccwsItem, http_session, link_resolver, walk_files, network_parser, setup_network, print_net_stats
+
 import json
-import time
-import random
-import urllib
 import os
 import re
 import hashlib
 import tempfile
 import subprocess
-from glob import glob
 import shutil
 
 TCGA_NS = Namespace("http://purl.org/bmeg/tcga/")
 TCGA_OWL = Namespace("http://purl.org/bmeg/tcga.owl#")
 BMEG_NS = Namespace("http://purl.org/bmeg/owl#")
 
-"""
-
-Net query code
-
-"""
-
-class dccwsItem(object):
-    baseURL = "http://tcga-data.nci.nih.gov/tcgadccws/GetXML?query="
-
-    def __init__(self):
-        self.url = None
-            
-    def __iter__(self):
-        next = self.url        
-        while next != None:
-            retry_count = 3
-            while retry_count > 0:
-                try:
-                    data = None
-                    handle = urllib.urlopen(next)
-                    data = handle.read()
-                    handle.close()
-                    dom = parseString(data)
-                    retry_count = 0
-                except Exception, e:
-                    retry_count -= 1
-                    if retry_count <= 0:
-                        sys.stderr.write("URL %s : Message Error: %s\n" % (next, data ) )
-                        raise e
-                    time.sleep(random.randint(10, 35))
-            # there might not be any archives for a dataset
-            if len(dom.getElementsByTagName('queryResponse')) > 0:
-                response = dom.getElementsByTagName('queryResponse').pop()
-                classList = response.getElementsByTagName('class')
-                for cls in classList:
-                    className = cls.getAttribute("recordNumber")
-                    outData = {}
-                    #aObj = Archive()
-                    for node in cls.childNodes:
-                        nodeName = node.getAttribute("name")
-                        if node.hasAttribute("xlink:href"):
-                            outData[ nodeName ] = node.getAttribute("xlink:href")            
-                        else:
-                            outData[ nodeName ] = getText( node.childNodes )
-                    yield outData
-            if len( dom.getElementsByTagName('next') ) > 0:
-                nextElm = dom.getElementsByTagName('next').pop()
-                next = nextElm.getAttribute( 'xlink:href' )
-            else:
-                next = None
-
-
-class CustomQuery(dccwsItem):
-    def __init__(self, query):
-        super(CustomQuery, self).__init__()
-        if query.startswith("http://"):
-            self.url = query
-        else:
-            self.url = dccwsItem.baseURL + query
-
-    
 def getText(nodelist):
     rc = []
     for node in nodelist:
@@ -143,12 +80,12 @@ def main_build(options):
     q = CustomQuery("Archive[@baseName=%s][@isLatest=1]" % (options.basename))
     for e in q:
         if acronym is None:
-            for a in CustomQuery(e['disease']):
+            for a in link_resolver.resolve(e['disease']):
                 acronym = a['abbreviation']
         if centerName is None:
-            for a in CustomQuery(e['center']):
+            for a in link_resolver.resolve(e['center']):
                 centerName = a['name']
-        urls.append( "https://tcga-data.nci.nih.gov" + e['deployLocation'])
+        urls.append( dccwsItem.dataURL + e['deployLocation'])
     
     if options.mirror is None:
         sys.stderr.write("Need mirror location\n")
@@ -167,8 +104,8 @@ def main_build(options):
                 os.makedirs(dir)
             if not os.path.exists( dst ):
                 print "download %s to %s" % (url, dst)
-                urllib.urlretrieve(url, dst)
-                urllib.urlretrieve(url + ".md5", dst + ".md5")
+                http_session.urlretrieve(url, dst)
+                http_session.urlretrieve(url + ".md5", dst + ".md5")
 
 
             if not os.path.exists( dst ):
@@ -417,16 +354,11 @@ class ClinicalParser:
             self.gr.add( (TCGA_NS[sub], TCGA_OWL[pred.replace(' ', '_')], obj_val) )
         
 def scandirs(path, filter_re):
-    if os.path.isdir(path):
-        out = []
-        for a in glob(os.path.join(path, "*")):
-            out.extend(scandirs(a, filter_re))
-        return out
-    else:
-        name = os.path.basename(path)
-        if filter_re.search(name):
-            return [path]
-        return []
+    out = []
+    for file, size in walk_files(path):
+        if filter_re.search(os.path.basename(file)):
+            out.append(file)
+    return out
         
     
 
@@ -448,11 +380,13 @@ if __name__ == "__main__":
 
     subparsers = parser.add_subparsers(title="subcommand")
 
-    parser_list = subparsers.add_parser('list')    
+    parser_net = network_parser()
+
+    parser_list = subparsers.add_parser('list', parents=[parser_net])
     parser_list.set_defaults(func=main_list)
 
 
-    parser_build = subparsers.add_parser('build')    
+    parser_build = subparsers.add_parser('build', parents=[parser_net])
     parser_build.add_argument("basename")
     parser_build.set_defaults(func=main_build)
     parser_build.add_argument("-m", "--mirror", dest="mirror", help="Mirror Location", default=None)
@@ -462,4 +396,8 @@ if __name__ == "__main__":
 
 
     args = parser.parse_args()
-    sys.exit(args.func(args))
+    setup_network(args)
+    ret = args.func(args)
+    if args.net_stats:
+        print_net_stats(sys.stderr)
+    sys.exit(ret)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+End to end checks of tcgaImport builds, run against small archives
+written into a temporary directory
+
+python -m unittest test_tcgaImport
+"""
+
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import tcgaImport
+
+
+BUILD_OPTIONS = dict(sanitize=False, mirror=None, outpath=None, download=False, download_only=False,
+    metapath=None, errorpath=None, clinical_type=None, download_workers=1, stream=False,
+    no_extract=False, extract_cache=None, extract_cache_size=None, extract_workers=1,
+    scan_workers=1, sort_workers=1, memory_budget=512, spill_dir=None, spill_codec="none",
+    columnar=True, float32_matrix=False, binary_matrix=False, out_clinical=[], uuid_table=None)
+
+
+class Options:
+    def __init__(self, **kw):
+        self.__dict__.update(BUILD_OPTIONS)
+        self.__dict__.update(kw)
+
+
+def write_archive(path, members):
+    """
+    members is a list of (name, data)
+    """
+    tar = tarfile.open(path, "w:gz")
+    for name, data in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, StringIO(data))
+    tar.close()
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, cls, archives, **kw):
+        """
+        Run a build of the archives (paths) with importer cls, returns the output directory
+        """
+        outdir = os.path.join(self.tmp, "out")
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.makedirs(outdir)
+        urls = dict( ("http://dcc/archive%d.tar.gz" % (i), path) for i, path in enumerate(archives) )
+        meta = { 'annotations' : {}, 'provenance' : { 'used' : [ { 'url' : url } for url in sorted(urls) ] } }
+        conf = tcgaImport.BuildConf("test", "TEST", "v1", meta, [])
+        conf.addOptions(Options(workdir_base=os.path.join(self.tmp, "work"), outdir=outdir, **kw))
+        conf.downloadAll = lambda urls, *args: []
+        conf.getURLPath = lambda url: urls[url]
+        cls(conf, conf.buildRequest()).run()
+        return outdir
+
+    def read(self, path):
+        handle = open(path)
+        data = handle.read()
+        handle.close()
+        return data
+
+
+class MafImportTest(BuildTest):
+    def test_maf_copied(self):
+        maf = "Hugo_Symbol\tEntrez_Gene_Id\tTumor_Sample_Barcode\nTP53\t7157\tTCGA-AB-0001-01A\n"
+        archive = os.path.join(self.tmp, "maf.tar.gz")
+        write_archive(archive, [ ("maf/test.somatic.maf", maf), ("maf/MANIFEST.txt", "x\n") ])
+        for kw in [ {}, { 'no_extract' : True } ]:
+            outdir = self.build(tcgaImport.MafImport, [archive], **kw)
+            self.assertEqual(self.read(os.path.join(outdir, "TEST.maf")), maf)
+            meta = json.loads(self.read(os.path.join(outdir, "TEST.maf.json")))
+            self.assertEqual(meta['annotations']['fileType'], "maf")
+
+
+class SpillOrderTest(BuildTest):
+    """
+    Records with the same key come out in the order 'sort -k 1' gave the
+    '<key>\\t<json>' spill lines, in both hash aggregation and external sort
+    (memory_budget 0)
+    """
+    def test_segments_within_sample(self):
+        seg = ("Sample\tChromosome\tStart\tEnd\tNum_Probes\tSegment_Mean\n"
+            "TCGA-AB-0001-01A\t1\t1000\t1999\t9\t0.5\n"
+            "TCGA-AB-0001-01A\t1\t3000\t3999\t10\t-0.25\n"
+            "TCGA-AB-0001-01A\t2\t100\t899\t120\t0.125\n"
+            "TCGA-AB-0001-01A\t1\t2000\t2999\t2\t0.5\n"
+            "TCGA-AB-0002-01A\t3\t500\t700\t31\t-1.5\n"
+            "TCGA-AB-0002-01A\t3\t100\t400\t4\t1.5\n")
+        sdrf = ("Extract Name\tDerived Data File\n"
+            "TCGA-AB-0001-01A\tseg.hg19.seg.txt\n"
+            "TCGA-AB-0002-01A\tseg.hg19.seg.txt\n")
+        archive = os.path.join(self.tmp, "snp.tar.gz")
+        write_archive(archive, [ ("snp/seg.hg19.seg.txt", seg), ("snp/seg.nocnv_hg19.seg.txt", seg), ("snp/x.sdrf.txt", sdrf) ])
+        for kw in [ {}, { 'memory_budget' : 0 } ]:
+            outdir = self.build(tcgaImport.SNP6Import, [archive], **kw)
+            self.assertEqual(self.read(os.path.join(outdir, "TEST.hg19.cna_probecount.bed")),
+                "chr1\t1000\t1999\tTCGA-AB-0001-01A\t9\n"
+                "chr1\t2000\t2999\tTCGA-AB-0001-01A\t2\n"
+                "chr1\t3000\t3999\tTCGA-AB-0001-01A\t10\n"
+                "chr2\t100\t899\tTCGA-AB-0001-01A\t120\n"
+                "chr3\t100\t400\tTCGA-AB-0002-01A\t4\n"
+                "chr3\t500\t700\tTCGA-AB-0002-01A\t31\n")
+
+    def test_duplicate_target(self):
+        #hyb_1 maps to two barcodes, the last one in JSON order wins
+        sdrf = ("Extract Name\tHybridization Name\tDerived Array Data Matrix File\n"
+            "TCGA-AB-0002-01A\thyb_1\ta.gene.txt\n"
+            "TCGA-AB-0001-01A-11R\thyb_1\ta.gene.txt\n"
+            "TCGA-AB-0003-01A\thyb_2\tb.gene.txt\n")
+        members = [ ("huex/x.sdrf.txt", sdrf) ]
+        for name, hyb, values in [ ("a", "hyb_1", ["1.5", "2.5", "3"]), ("b", "hyb_2", ["4", "5", "6"]) ]:
+            data = "Hybridization REF\t%s\nComposite Element REF\tSignal\n" % (hyb)
+            data += "".join( "gene_%d\t%s\n" % (i, v) for i, v in enumerate(values) )
+            members.append( ("huex/%s.gene.txt" % (name), data) )
+        archive = os.path.join(self.tmp, "huex.tar.gz")
+        write_archive(archive, members)
+        for kw in [ {}, { 'memory_budget' : 0 }, { 'columnar' : False } ]:
+            outdir = self.build(tcgaImport.HuEx1_0stv2, [archive], **kw)
+            self.assertEqual(self.read(os.path.join(outdir, "TEST.miRNAExp.tsv")),
+                "#probe\tTCGA-AB-0003-01A\tTCGA-AB-0002-01A\tTCGA-AB-0001-01A-11R\n"
+                "gene_0\t4\t1.5\tNA\n"
+                "gene_1\t5\t2.5\tNA\n")
+
+
+class MageTest(BuildTest):
+    def test_sdrf_line_ends(self):
+        #SDRF files are read with universal newlines, in place as well as extracted
+        data = "Hybridization REF\thyb_1\nComposite Element REF\tSignal\ngene_0\t1.5\ngene_1\t2.5\n"
+        for newline in [ "\r", "\r\n" ]:
+            sdrf = newline.join( [ "Extract Name\tHybridization Name\tDerived Array Data Matrix File",
+                "TCGA-AB-0001-01A\thyb_1\ta.gene.txt", "" ] )
+            archive = os.path.join(self.tmp, "huex.tar.gz")
+            write_archive(archive, [ ("huex/x.sdrf.txt", sdrf), ("huex/a.gene.txt", data) ])
+            for kw in [ {}, { 'no_extract' : True } ]:
+                outdir = self.build(tcgaImport.HuEx1_0stv2, [archive], **kw)
+                self.assertEqual(self.read(os.path.join(outdir, "TEST.miRNAExp.tsv")),
+                    "#probe\tTCGA-AB-0001-01A\ngene_0\t1.5\n")
+
+
+class ColumnarTest(BuildTest):
+    def test_shared_barcode(self):
+        #hyb_1 and hyb_2 are replicates of one aliquot, so share its column
+        sdrf = ("Extract Name\tHybridization Name\tDerived Array Data Matrix File\n"
+            "TCGA-AB-0001-01A\thyb_1\ta.gene.txt\n"
+            "TCGA-AB-0001-01A\thyb_2\tb.gene.txt\n"
+            "TCGA-AB-0002-01A\thyb_3\tc.gene.txt\n")
+        files = [ ("a", "hyb_1", ["1e-5", "", "0.5", "7", "2"]),
+            ("b", "hyb_2", ["2", "0.25", "", "NA", "2"]),
+            ("c", "hyb_3", ["4", "5", "", "6", "1"]) ]
+        members = [ ("huex/x.sdrf.txt", sdrf) ]
+        for name, hyb, values in files:
+            data = "Hybridization REF\t%s\nComposite Element REF\tSignal\n" % (hyb)
+            #an empty value is a short row, read as NA
+            data += "".join( "gene_%d\t%s\n" % (i, v) if len(v) else "gene_%d\n" % (i) for i, v in enumerate(values) )
+            members.append( ("huex/%s.gene.txt" % (name), data) )
+        archive = os.path.join(self.tmp, "huex.tar.gz")
+        write_archive(archive, members)
+        expected = self.read(os.path.join(self.build(tcgaImport.HuEx1_0stv2, [archive], columnar=False), "TEST.miRNAExp.tsv"))
+        for kw in [ {}, { 'memory_budget' : 0 } ]:
+            outdir = self.build(tcgaImport.HuEx1_0stv2, [archive], **kw)
+            self.assertEqual(self.read(os.path.join(outdir, "TEST.miRNAExp.tsv")), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()